@@ -1,5 +1,9 @@
+import copy
+
 import torch
 from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.utils.checkpoint import checkpoint
 
 __all__ = ['UNet', 'NestedUNet']
 
@@ -12,8 +16,15 @@ class VGGBlock(nn.Module):
         self.bn1 = nn.BatchNorm2d(middle_channels)
         self.conv2 = nn.Conv2d(middle_channels, out_channels, 3, padding=1)
         self.bn2 = nn.BatchNorm2d(out_channels)
+        # 训练时不保存中间激活，反向传播时重新计算
+        self.checkpoint = False
 
     def forward(self, x):
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint(self._forward, x, use_reentrant=False)
+        return self._forward(x)
+
+    def _forward(self, x):
         out = self.conv1(x)
         out = self.bn1(out)
         out = self.relu(out)
@@ -24,113 +35,211 @@ class VGGBlock(nn.Module):
 
         return out
 
+    def fuse(self):
+        # eval 模式下 BN 只是逐通道仿射变换，可以并入卷积的权重和偏置
+        self.conv1 = fuse_conv_bn_eval(self.conv1, self.bn1)
+        self.bn1 = nn.Identity()
+        self.conv2 = fuse_conv_bn_eval(self.conv2, self.bn2)
+        self.bn2 = nn.Identity()
+
+
+def filter_widths(width_mult=1.0, depth=5):
+    """Channels of the resolution levels 0..depth-1: 32, 64, 128, 256, 512
+    scaled by width_mult. depth is 2-5, so the input size stays divisible by 16."""
+    if depth not in (2, 3, 4, 5):
+        raise ValueError('depth must be 2-5, got %r' % (depth,))
+    return [max(1, int(round(c * width_mult))) for c in [32, 64, 128, 256, 512][:depth]]
+
 
 class UNet(nn.Module):
-    def __init__(self, num_classes, input_channels=3, **kwargs):
+    def __init__(self, num_classes, input_channels=3, width_mult=1.0, depth=5, **kwargs):
         super().__init__()
 
-        nb_filter = [32, 64, 128, 256, 512]
+        # width_mult < 1 得到更窄、更快的网络（例如蒸馏的 student），depth 为分辨率层数
+        nb_filter = filter_widths(width_mult, depth)
+
+        self.nb_filter = nb_filter
+        self.depth = depth
 
         self.pool = nn.MaxPool2d(2, 2)
         self.up = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
 
         self.conv0_0 = VGGBlock(input_channels, nb_filter[0], nb_filter[0])
-        self.conv1_0 = VGGBlock(nb_filter[0], nb_filter[1], nb_filter[1])
-        self.conv2_0 = VGGBlock(nb_filter[1], nb_filter[2], nb_filter[2])
-        self.conv3_0 = VGGBlock(nb_filter[2], nb_filter[3], nb_filter[3])
-        self.conv4_0 = VGGBlock(nb_filter[3], nb_filter[4], nb_filter[4])
+        for i in range(1, depth):
+            setattr(self, 'conv%d_0' % i, VGGBlock(nb_filter[i - 1], nb_filter[i], nb_filter[i]))
 
-        self.conv3_1 = VGGBlock(nb_filter[3]+nb_filter[4], nb_filter[3], nb_filter[3])
-        self.conv2_2 = VGGBlock(nb_filter[2]+nb_filter[3], nb_filter[2], nb_filter[2])
-        self.conv1_3 = VGGBlock(nb_filter[1]+nb_filter[2], nb_filter[1], nb_filter[1])
-        self.conv0_4 = VGGBlock(nb_filter[0]+nb_filter[1], nb_filter[0], nb_filter[0])
+        # 解码器 conv3_1, conv2_2, conv1_3, conv0_4（depth=5 时）
+        for i in reversed(range(depth - 1)):
+            setattr(self, 'conv%d_%d' % (i, depth - 1 - i),
+                    VGGBlock(nb_filter[i] + nb_filter[i + 1], nb_filter[i], nb_filter[i]))
 
         self.final = nn.Conv2d(nb_filter[0], num_classes, kernel_size=1)
 
 
     def forward(self, input):
-        x0_0 = self.conv0_0(input)
-        x1_0 = self.conv1_0(self.pool(x0_0))
-        x2_0 = self.conv2_0(self.pool(x1_0))
-        x3_0 = self.conv3_0(self.pool(x2_0))
-        x4_0 = self.conv4_0(self.pool(x3_0))
-
-        x3_1 = self.conv3_1(torch.cat([x3_0, self.up(x4_0)], 1))
-        x2_2 = self.conv2_2(torch.cat([x2_0, self.up(x3_1)], 1))
-        x1_3 = self.conv1_3(torch.cat([x1_0, self.up(x2_2)], 1))
-        x0_4 = self.conv0_4(torch.cat([x0_0, self.up(x1_3)], 1))
-
-        output = self.final(x0_4)
+        x = self.conv0_0(input)
+        skips = [x]
+        for i in range(1, self.depth):
+            x = getattr(self, 'conv%d_0' % i)(self.pool(x))
+            skips.append(x)
+
+        for i in reversed(range(self.depth - 1)):
+            x = getattr(self, 'conv%d_%d' % (i, self.depth - 1 - i))(torch.cat([skips[i], self.up(x)], 1))
+
+        output = self.final(x)
         return output
 
 # Unet++ (https://arxiv.org/pdf/1807.10165.pdf)
 class NestedUNet(nn.Module):
-    def __init__(self, num_classes, input_channels=3, deep_supervision=False, **kwargs):
+    def __init__(self, num_classes, input_channels=3, deep_supervision=False, width_mult=1.0, depth=5,
+                 **kwargs):
         super().__init__()
 
-        nb_filter = [32, 64, 128, 256, 512]
+        nb_filter = filter_widths(width_mult, depth)
 
+        self.nb_filter = nb_filter
+        self.depth = depth
         self.deep_supervision = deep_supervision
+        # 推理时的提前退出层级 (1 到 depth-1)，None 表示完整网络
+        self.exit_level = None
+        # 推理时用预分配的通道缓冲区代替 torch.cat（仅在 eval 且不求梯度时生效）
+        self.dense_buffers = False
 
         self.pool = nn.MaxPool2d(2, 2)
         self.up = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
 
         self.conv0_0 = VGGBlock(input_channels, nb_filter[0], nb_filter[0])
-        self.conv1_0 = VGGBlock(nb_filter[0], nb_filter[1], nb_filter[1])
-        self.conv2_0 = VGGBlock(nb_filter[1], nb_filter[2], nb_filter[2])
-        self.conv3_0 = VGGBlock(nb_filter[2], nb_filter[3], nb_filter[3])
-        self.conv4_0 = VGGBlock(nb_filter[3], nb_filter[4], nb_filter[4])
-
-        self.conv0_1 = VGGBlock(nb_filter[0]+nb_filter[1], nb_filter[0], nb_filter[0])
-        self.conv1_1 = VGGBlock(nb_filter[1]+nb_filter[2], nb_filter[1], nb_filter[1])
-        self.conv2_1 = VGGBlock(nb_filter[2]+nb_filter[3], nb_filter[2], nb_filter[2])
-        self.conv3_1 = VGGBlock(nb_filter[3]+nb_filter[4], nb_filter[3], nb_filter[3])
+        for i in range(1, depth):
+            setattr(self, 'conv%d_0' % i, VGGBlock(nb_filter[i - 1], nb_filter[i], nb_filter[i]))
 
-        self.conv0_2 = VGGBlock(nb_filter[0]*2+nb_filter[1], nb_filter[0], nb_filter[0])
-        self.conv1_2 = VGGBlock(nb_filter[1]*2+nb_filter[2], nb_filter[1], nb_filter[1])
-        self.conv2_2 = VGGBlock(nb_filter[2]*2+nb_filter[3], nb_filter[2], nb_filter[2])
-
-        self.conv0_3 = VGGBlock(nb_filter[0]*3+nb_filter[1], nb_filter[0], nb_filter[0])
-        self.conv1_3 = VGGBlock(nb_filter[1]*3+nb_filter[2], nb_filter[1], nb_filter[1])
-
-        self.conv0_4 = VGGBlock(nb_filter[0]*4+nb_filter[1], nb_filter[0], nb_filter[0])
+        # xi_j 的输入为 xi_0 ... xi_(j-1) 与上采样的 x(i+1)_(j-1)
+        for j in range(1, depth):
+            for i in range(depth - j):
+                setattr(self, 'conv%d_%d' % (i, j),
+                        VGGBlock(nb_filter[i] * j + nb_filter[i + 1], nb_filter[i], nb_filter[i]))
 
         if self.deep_supervision:
-            self.final1 = nn.Conv2d(nb_filter[0], num_classes, kernel_size=1)
-            self.final2 = nn.Conv2d(nb_filter[0], num_classes, kernel_size=1)
-            self.final3 = nn.Conv2d(nb_filter[0], num_classes, kernel_size=1)
-            self.final4 = nn.Conv2d(nb_filter[0], num_classes, kernel_size=1)
+            for level in range(1, depth):
+                setattr(self, 'final%d' % level, nn.Conv2d(nb_filter[0], num_classes, kernel_size=1))
         else:
             self.final = nn.Conv2d(nb_filter[0], num_classes, kernel_size=1)
 
 
     def forward(self, input):
-        x0_0 = self.conv0_0(input)
-        x1_0 = self.conv1_0(self.pool(x0_0))
-        x0_1 = self.conv0_1(torch.cat([x0_0, self.up(x1_0)], 1))
-
-        x2_0 = self.conv2_0(self.pool(x1_0))
-        x1_1 = self.conv1_1(torch.cat([x1_0, self.up(x2_0)], 1))
-        x0_2 = self.conv0_2(torch.cat([x0_0, x0_1, self.up(x1_1)], 1))
+        # 缓冲区会被原地改写，autograd 保存的张量因此失效，训练时走普通路径
+        if self.dense_buffers and not self.training and not torch.is_grad_enabled():
+            return self.forward_buffered(input, self.exit_level)
+        if self.exit_level is not None:
+            return self.forward_exit(input, self.exit_level)
 
-        x3_0 = self.conv3_0(self.pool(x2_0))
-        x2_1 = self.conv2_1(torch.cat([x2_0, self.up(x3_0)], 1))
-        x1_2 = self.conv1_2(torch.cat([x1_0, x1_1, self.up(x2_1)], 1))
-        x0_3 = self.conv0_3(torch.cat([x0_0, x0_1, x0_2, self.up(x1_2)], 1))
-
-        x4_0 = self.conv4_0(self.pool(x3_0))
-        x3_1 = self.conv3_1(torch.cat([x3_0, self.up(x4_0)], 1))
-        x2_2 = self.conv2_2(torch.cat([x2_0, x2_1, self.up(x3_1)], 1))
-        x1_3 = self.conv1_3(torch.cat([x1_0, x1_1, x1_2, self.up(x2_2)], 1))
-        x0_4 = self.conv0_4(torch.cat([x0_0, x0_1, x0_2, x0_3, self.up(x1_3)], 1))
+        x = self._nodes(input, self.depth - 1)
 
         if self.deep_supervision:
-            output1 = self.final1(x0_1)
-            output2 = self.final2(x0_2)
-            output3 = self.final3(x0_3)
-            output4 = self.final4(x0_4)
-            return [output1, output2, output3, output4]
+            return [getattr(self, 'final%d' % level)(x[0][level]) for level in range(1, self.depth)]
 
         else:
-            output = self.final(x0_4)
+            output = self.final(x[0][self.depth - 1])
             return output
+
+    def _check_level(self, level):
+        if level not in range(1, self.depth):
+            raise ValueError('exit level must be 1-%d, got %r' % (self.depth - 1, level))
+        if level < self.depth - 1 and not self.deep_supervision:
+            raise ValueError('exit level %d needs deep_supervision heads' % level)
+
+    def _head(self, level, x):
+        if self.deep_supervision:
+            return getattr(self, 'final%d' % level)(x)
+        return self.final(x)
+
+    def _nodes(self, input, level):
+        """Nodes xi_j with i + j <= level as x[i][j], computed diagonal by diagonal."""
+        x = [[None] * (self.depth - i) for i in range(self.depth)]
+        for d in range(level + 1):
+            if d == 0:
+                x[0][0] = self.conv0_0(input)
+            else:
+                x[d][0] = getattr(self, 'conv%d_0' % d)(self.pool(x[d - 1][0]))
+            for j in range(1, d + 1):
+                i = d - j
+                x[i][j] = getattr(self, 'conv%d_%d' % (i, j))(torch.cat(x[i][:j] + [self.up(x[i + 1][j - 1])], 1))
+        return x
+
+    def forward_exit(self, input, level):
+        """Pruned UNet++ inference: compute only the sub-network that feeds
+        x0_<level> and return the output of that head (final1..final<depth-1>)."""
+        self._check_level(level)
+        x = self._nodes(input, level)
+        return self._head(level, x[0][level])
+
+    def forward_buffered(self, input, level=None):
+        """Inference-only forward that writes each resolution level into one
+        preallocated channel buffer, so the dense skip inputs of every
+        xi_j are views of that buffer instead of torch.cat copies.
+
+        Level i holds xi_0, xi_1, ... side by side. Before computing xi_j the
+        upsampled x(i+1)_(j-1) is written right behind xi_(j-1), the block
+        reads the buffer prefix, and xi_j then overwrites the start of that
+        upsample slot. level selects an exit head like forward_exit.
+        """
+        if level is not None:
+            self._check_level(level)
+
+        nb_filter = self.nb_filter
+        top = self.depth - 1
+        depth = top if level is None else level
+        buffers = []
+        x = [[None] * (self.depth - i) for i in range(self.depth)]
+
+        def store(i, j, out):
+            if i == 0 and j == 0:
+                # 缓冲区跟随第一个卷积输出的 dtype（兼容 autocast）
+                for k in range(top):
+                    channels = nb_filter[k] * (top - k) + nb_filter[k + 1]
+                    buffers.append(out.new_empty(out.size(0), channels,
+                                                 out.size(2) >> k, out.size(3) >> k))
+            if i + j >= top:
+                # 每层最后一个节点只被上一层的上采样或 final 使用，不需要放进缓冲区
+                x[i][j] = out
+            else:
+                view = buffers[i][:, nb_filter[i] * j:nb_filter[i] * (j + 1)]
+                view.copy_(out)
+                x[i][j] = view
+
+        for d in range(depth + 1):
+            if d == 0:
+                store(0, 0, self.conv0_0(input))
+            else:
+                store(d, 0, getattr(self, 'conv%d_0' % d)(self.pool(x[d - 1][0])))
+            for j in range(1, d + 1):
+                i = d - j
+                start = nb_filter[i] * j
+                stop = start + nb_filter[i + 1]
+                buffers[i][:, start:stop] = self.up(x[i + 1][j - 1])
+                store(i, j, getattr(self, 'conv%d_%d' % (i, j))(buffers[i][:, :stop]))
+
+        if level is not None:
+            return self._head(level, x[0][level])
+
+        if self.deep_supervision:
+            return [getattr(self, 'final%d' % k)(x[0][k]) for k in range(1, self.depth)]
+        return self.final(x[0][top])
+
+
+def set_checkpointing(model, levels):
+    """Enable gradient checkpointing on the VGGBlocks conv<i>_<j> of model
+    whose resolution level i is in levels ('all' selects every block)."""
+    for name, module in model.named_children():
+        if isinstance(module, VGGBlock):
+            level = int(name[len('conv'):].split('_')[0])
+            module.checkpoint = levels == 'all' or level in levels
+
+
+def fuse_for_inference(model):
+    """Return an eval-mode copy of a UNet/NestedUNet with bn1/bn2 of every
+    VGGBlock folded into conv1/conv2. The copy is for inference only."""
+    model = copy.deepcopy(model).eval()
+    for module in model.modules():
+        if isinstance(module, VGGBlock):
+            module.fuse()
+    return model
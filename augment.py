@@ -0,0 +1,77 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+__all__ = ['BatchAugment']
+
+
+class BatchAugment(nn.Module):
+    """Random flips, rotation, scaling, elastic deformation and intensity
+    jitter applied to a whole (N, C, H, W) image/mask batch on its device.
+
+    All geometric transforms are combined into one sampling grid, so a batch
+    costs a single grid_sample for the images (bilinear) and one for the
+    masks (nearest, masks stay binary). Each sample draws its own parameters.
+    """
+
+    def __init__(self, flip=0.5, rotate=15, scale=0.1, elastic_alpha=0.02, elastic_grid=8,
+                 brightness=0.1, contrast=0.1):
+        """
+        Args:
+            flip (float): Probability of a horizontal and, independently, of a vertical flip.
+            rotate (float): Maximum rotation in degrees.
+            scale (float): Maximum relative zoom in or out.
+            elastic_alpha (float): Standard deviation of the elastic displacement,
+                in units of half the image size (0 disables it).
+            elastic_grid (int): Side of the coarse random displacement grid that is
+                upsampled to the image, smaller is smoother.
+            brightness (float): Maximum additive intensity shift.
+            contrast (float): Maximum relative contrast change around the slice mean.
+        """
+        super().__init__()
+        self.flip = flip
+        self.rotate = rotate
+        self.scale = scale
+        self.elastic_alpha = elastic_alpha
+        self.elastic_grid = elastic_grid
+        self.brightness = brightness
+        self.contrast = contrast
+
+    def _uniform(self, n, limit, device):
+        return (torch.rand(n, device=device) * 2 - 1) * limit
+
+    @torch.no_grad()
+    def forward(self, input, target):
+        n, _, h, w = input.shape
+        device = input.device
+
+        angle = self._uniform(n, self.rotate * math.pi / 180, device)
+        zoom = 1 + self._uniform(n, self.scale, device)
+        flip_x = torch.where(torch.rand(n, device=device) < self.flip, -1.0, 1.0)
+        flip_y = torch.where(torch.rand(n, device=device) < self.flip, -1.0, 1.0)
+        cos = torch.cos(angle) / zoom
+        sin = torch.sin(angle) / zoom
+        zero = torch.zeros_like(angle)
+        theta = torch.stack([
+            torch.stack([cos * flip_x, -sin * flip_y, zero], 1),
+            torch.stack([sin * flip_x, cos * flip_y, zero], 1),
+        ], 1)
+        grid = F.affine_grid(theta, (n, 1, h, w), align_corners=False)
+
+        if self.elastic_alpha > 0:
+            # 低分辨率随机位移场插值到原图大小，得到平滑的弹性形变
+            noise = torch.randn(n, 2, self.elastic_grid, self.elastic_grid, device=device) * self.elastic_alpha
+            noise = F.interpolate(noise, size=(h, w), mode='bicubic', align_corners=False)
+            grid = grid + noise.permute(0, 2, 3, 1)
+
+        input = F.grid_sample(input, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        target = F.grid_sample(target, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+        mean = input.mean(dim=(1, 2, 3), keepdim=True)
+        contrast = 1 + self._uniform(n, self.contrast, device).view(n, 1, 1, 1)
+        brightness = self._uniform(n, self.brightness, device).view(n, 1, 1, 1)
+        input = ((input - mean) * contrast + mean + brightness).clamp_(0, 1)
+
+        return input, target
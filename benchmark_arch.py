@@ -0,0 +1,121 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import pandas as pd
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+import archs
+from utils import AverageMeter, count_params, str2bool
+
+
+def parse_args(img_size=512):
+    parser = argparse.ArgumentParser(
+        description='Parameters, FLOPs, CPU latency and validation IoU of a grid of '
+                    'width_mult / depth settings. Unknown arguments are passed on to '
+                    'train_woDS.py when --train is set.')
+
+    parser.add_argument('--name', default='grid',
+                        help='grid name, setting w/d trains models/<name>_w<w>_d<d>')
+    parser.add_argument('--arch', default='NestedUNet', choices=archs.__all__)
+    parser.add_argument('--width_mults', default='0.25,0.5,1',
+                        help='comma-separated width multipliers')
+    parser.add_argument('--depths', default='3,4,5',
+                        help='comma-separated depths (2-5)')
+    parser.add_argument('--input_channels', default=1, type=int)
+    parser.add_argument('--input_size', default=img_size, type=int,
+                        help='side of the slice used for FLOPs and latency')
+    parser.add_argument('--train', default=False, type=str2bool,
+                        help='train the settings that have no models/<name>_w<w>_d<d>/log.csv yet')
+    parser.add_argument('--repeat', default=10, type=int,
+                        help='timed CPU forward passes per setting')
+    parser.add_argument('--num_threads', default=None, type=int,
+                        help='torch CPU threads (default: torch default)')
+
+    args, train_args = parser.parse_known_args()
+
+    return args, train_args
+
+
+def cpu_latency(model, input, repeat=10):
+    """Mean milliseconds of one forward pass after a warm-up pass."""
+    latency = AverageMeter()
+    with torch.no_grad():
+        model(input)
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model(input)
+            latency.update((time.perf_counter() - start) * 1000)
+    return latency.avg
+
+
+def count_flops(model, input):
+    with torch.no_grad(), FlopCounterMode(display=False) as counter:
+        model(input)
+    return counter.get_total_flops()
+
+
+def main():
+    args, train_args = parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    width_mults = [float(w) for w in args.width_mults.split(',')]
+    depths = [int(d) for d in args.depths.split(',')]
+    input = torch.randn(1, args.input_channels, args.input_size, args.input_size)
+
+    log = OrderedDict([
+        ('model', []),
+        ('width_mult', []),
+        ('depth', []),
+        ('params', []),
+        ('gflops', []),
+        ('latency_ms', []),
+        ('val_iou', []),
+    ])
+    for depth in depths:
+        for width_mult in width_mults:
+            name = '%s_w%g_d%d' % (args.name, width_mult, depth)
+            log_path = 'models/%s/log.csv' % name
+            if args.train and not os.path.exists(log_path):
+                cmd = [sys.executable, 'train_woDS.py'] + train_args + [
+                    '--name', name,
+                    '--arch', args.arch,
+                    '--input_channels', str(args.input_channels),
+                    '--width_mult', str(width_mult),
+                    '--depth', str(depth),
+                ]
+                print('=> training %s: %s' % (name, ' '.join(cmd)))
+                subprocess.run(cmd, check=True)
+
+            # 参数量、FLOPs 与延迟与权重无关，未训练的设置也可以比较
+            model = archs.__dict__[args.arch](1, args.input_channels, width_mult=width_mult, depth=depth)
+            model.eval()
+
+            val_iou = float('nan')
+            if os.path.exists(log_path):
+                val_iou = pd.read_csv(log_path)['val_iou'].max()
+
+            log['model'].append(name)
+            log['width_mult'].append(width_mult)
+            log['depth'].append(depth)
+            log['params'].append(count_params(model))
+            log['gflops'].append(count_flops(model, input) / 1e9)
+            log['latency_ms'].append(cpu_latency(model, input, args.repeat))
+            log['val_iou'].append(val_iou)
+            print('=> %s: %d params, %.2f GFLOPs, %.1f ms' % (name, log['params'][-1], log['gflops'][-1],
+                                                          log['latency_ms'][-1]))
+
+    log = pd.DataFrame(log)
+    os.makedirs('models/%s' % args.name, exist_ok=True)
+    log.to_csv('models/%s/grid.csv' % args.name, index=False)
+    print(log.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
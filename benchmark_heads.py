@@ -0,0 +1,75 @@
+import argparse
+from collections import OrderedDict
+
+import pandas as pd
+import torch
+
+from predict import evaluate, load_config, load_model, make_loader, train_val_split
+
+
+def parse_args(img_size=512):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--name', default='ICH' + str(img_size) + '_NestedUNet_wDS',
+                        help='model name (NestedUNet trained with deep_supervision)')
+    parser.add_argument('-b', '--batch_size', default=None, type=int,
+                        help='inference batch size (default: batch_size in config.yml)')
+    parser.add_argument('--num_threads', default=None, type=int,
+                        help='torch CPU threads (default: torch default)')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def main():
+    args = parse_args()
+    config = load_config(args.name)
+
+    if config['arch'] != 'NestedUNet' or not config['deep_supervision']:
+        raise ValueError('%s is not a NestedUNet trained with deep_supervision' % args.name)
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = load_model(config, device)
+
+    # 与 train_woDS.py 相同的验证集划分
+    _, val_img_ids = train_val_split(config)
+    val_loader = make_loader(config, val_img_ids, args.batch_size or config['batch_size'])
+
+    # warm-up，避免第一个 head 的计时包含初始化开销
+    input, _, _ = next(iter(val_loader))
+    with torch.no_grad():
+        model.forward_exit(input.to(device), model.depth - 1)
+
+    log = OrderedDict([
+        ('head', []),
+        ('dice', []),
+        ('iou', []),
+        ('latency_ms', []),
+        ('speedup', []),
+    ])
+    results = []
+    heads = list(range(1, model.depth))
+    for head in heads:
+        print('=> evaluating head L%d' % head)
+        model.exit_level = head
+        results.append(evaluate(model, val_loader, device))
+
+    full_latency = results[-1]['latency_ms']
+    for head, result in zip(heads, results):
+        log['head'].append('L%d' % head)
+        log['dice'].append(result['dice'])
+        log['iou'].append(result['iou'])
+        log['latency_ms'].append(result['latency_ms'])
+        log['speedup'].append(full_latency / result['latency_ms'])
+
+    log = pd.DataFrame(log)
+    log.to_csv('models/%s/heads.csv' % config['name'], index=False)
+    print(log.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
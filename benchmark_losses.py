@@ -0,0 +1,66 @@
+import argparse
+import time
+from collections import OrderedDict
+
+import pandas as pd
+import torch
+
+import losses
+
+
+def parse_args(img_size=512):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-b', '--batch_size', default=16, type=int)
+    parser.add_argument('--input_size', default=img_size, type=int,
+                        help='side of the square logit maps')
+    parser.add_argument('--repeat', default=20, type=int,
+                        help='timed forward + backward passes per loss')
+    parser.add_argument('--fg_ratio', default=0.05, type=float,
+                        help='share of foreground pixels in the random masks')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def time_loss(criterion, input, target, repeat, device):
+    """Mean milliseconds of criterion forward + backward."""
+    for i in range(repeat + 2):
+        # 前两次为 warm-up
+        if i == 2:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        input.grad = None
+        criterion(input, target).backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def main():
+    args = parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    shape = (args.batch_size, 1, args.input_size, args.input_size)
+    input = torch.randn(shape, device=device, requires_grad=True)
+    target = (torch.rand(shape, device=device) < args.fg_ratio).float()
+
+    log = OrderedDict([
+        ('loss', []),
+        ('step_ms', []),
+    ])
+    for name in ['BCEDiceLoss', 'LovaszHingeLoss']:
+        criterion = losses.__dict__[name]()
+        log['loss'].append(name)
+        log['step_ms'].append(time_loss(criterion, input, target, args.repeat, device))
+
+    log = pd.DataFrame(log)
+    log['relative'] = log['step_ms'] / log['step_ms'][0]
+    print('%s, batch %d, %dx%d' % (device.type, args.batch_size, args.input_size, args.input_size))
+    print(log.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import os
+
+import torch
+
+from utils import file_hash
+
+__all__ = ['cache_key', 'compile_model']
+
+
+def cache_key(config, backend, head=None, fuse=False, dense_buffers=False):
+    """Name of the compiled artefact: arch, input size, torch version,
+    checkpoint hash and every option that changes the traced graph."""
+    parts = [config['arch'],
+             '%dx%d' % (config['input_h'], config['input_w']),
+             'torch' + torch.__version__.replace('+', '-'),
+             file_hash('models/%s/model.pth' % config['name'])[:12],
+             backend]
+    if head is not None:
+        parts.append('L%d' % head)
+    if fuse:
+        parts.append('fused')
+    if dense_buffers:
+        parts.append('dense')
+    return '_'.join(parts)
+
+
+def compile_model(model, config, backend, device, key, batch_size=1):
+    """Compile model with TorchScript or torch.compile, reusing the artefact
+    cached under models/<name>/compiled/ when one exists for key, then run a
+    warm-up pass on a dummy input_h x input_w batch.
+
+    torchscript: the frozen traced module is saved as <key>.pt and loaded
+    directly on later runs. inductor: torch.compile writes its FX graph and
+    kernel caches to <key>/, so later processes skip code generation.
+    """
+    cache_dir = os.path.join('models', config['name'], 'compiled')
+    os.makedirs(cache_dir, exist_ok=True)
+    dummy = torch.zeros(batch_size, config['input_channels'], config['input_h'], config['input_w'],
+                        device=device)
+
+    if backend == 'torchscript':
+        path = os.path.join(cache_dir, key + '.pt')
+        if os.path.exists(path):
+            print('=> loading compiled model %s' % path)
+            model = torch.jit.load(path, map_location=device)
+        else:
+            print('=> compiling model to %s' % path)
+            with torch.no_grad():
+                model = torch.jit.trace(model, dummy, strict=False)
+            model = torch.jit.freeze(model.eval())
+            # 先写临时文件再替换，避免并发进程读到写了一半的文件
+            torch.jit.save(model, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        # optimize_for_inference 生成的 mkldnn 图不能序列化，加载后再做
+        model = torch.jit.optimize_for_inference(model)
+    elif backend == 'inductor':
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, key))
+        model = torch.compile(model)
+    else:
+        raise NotImplementedError
+
+    # warm-up
+    with torch.no_grad():
+        model(dummy)
+
+    return model
@@ -0,0 +1,99 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Patient-grouped k-fold cross-validation of train_woDS.py. '
+                    'Unknown arguments are passed on to every fold.')
+
+    parser.add_argument('--name', default='ICH512_NestedUNet_cv',
+                        help='base model name, fold i trains models/<name>_fold<i>')
+    parser.add_argument('--folds', default=5, type=int,
+                        help='number of folds')
+    parser.add_argument('--jobs', default=None, type=int,
+                        help='folds trained concurrently (default: all folds)')
+    parser.add_argument('--threads', default=None, type=int,
+                        help='CPU threads per fold (default: cpu_count // jobs)')
+
+    args, train_args = parser.parse_known_args()
+
+    return args, train_args
+
+
+def summarize(name, folds):
+    """Best val_iou epoch of every fold's log.csv, plus mean and std rows."""
+    summary = OrderedDict([
+        ('fold', []),
+        ('epoch', []),
+        ('loss', []),
+        ('iou', []),
+        ('val_loss', []),
+        ('val_iou', []),
+    ])
+    for fold in range(folds):
+        log = pd.read_csv('models/%s_fold%d/log.csv' % (name, fold))
+        best = log.loc[log['val_iou'].idxmax()]
+        summary['fold'].append(str(fold))
+        for key in ['epoch', 'loss', 'iou', 'val_loss', 'val_iou']:
+            summary[key].append(best[key])
+
+    summary = pd.DataFrame(summary)
+    stats = summary.drop(columns='fold').agg(['mean', 'std'])
+    stats.insert(0, 'fold', stats.index)
+    return pd.concat([summary, stats], ignore_index=True)
+
+
+def main():
+    args, train_args = parse_args()
+    jobs = args.jobs or args.folds
+    threads = args.threads or max(1, (os.cpu_count() or 1) // jobs)
+
+    # 限制每个进程的线程数，避免并发的 fold 互相争抢 CPU
+    env = dict(os.environ)
+    for key in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        env[key] = str(threads)
+
+    pending = list(range(args.folds))
+    running = {}
+    failed = []
+    while pending or running:
+        while pending and len(running) < jobs:
+            fold = pending.pop(0)
+            os.makedirs('models/%s_fold%d' % (args.name, fold), exist_ok=True)
+            cmd = [sys.executable, 'train_woDS.py'] + train_args + [
+                '--name', '%s_fold%d' % (args.name, fold),
+                '--folds', str(args.folds),
+                '--fold', str(fold),
+                '--num_threads', str(threads),
+            ]
+            stdout = open('models/%s_fold%d/train.out' % (args.name, fold), 'w')
+            print('=> fold %d: %s' % (fold, ' '.join(cmd)))
+            running[fold] = (subprocess.Popen(cmd, env=env, stdout=stdout, stderr=subprocess.STDOUT), stdout)
+
+        for fold, (proc, stdout) in list(running.items()):
+            if proc.poll() is not None:
+                stdout.close()
+                del running[fold]
+                if proc.returncode != 0:
+                    failed.append(fold)
+                print('=> fold %d finished with exit code %d' % (fold, proc.returncode))
+        time.sleep(1)
+
+    if failed:
+        raise RuntimeError('folds %s failed, see models/%s_fold<i>/train.out' % (failed, args.name))
+
+    summary = summarize(args.name, args.folds)
+    os.makedirs('models/%s' % args.name, exist_ok=True)
+    summary.to_csv('models/%s/summary.csv' % args.name, index=False)
+    print(summary.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
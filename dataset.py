@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 
 import cv2
@@ -6,7 +8,8 @@ import torch.utils.data
 
 
 class Dataset(torch.utils.data.Dataset):
-    def __init__(self, img_ids, img_dir, mask_dir, img_ext, mask_ext, num_classes, transform=None):
+    def __init__(self, img_ids, img_dir, mask_dir, img_ext, mask_ext, num_classes, transform=None,
+                 input_channels=3):
         """
         Args:
             img_ids (list): Image ids.
@@ -16,6 +19,7 @@ class Dataset(torch.utils.data.Dataset):
             mask_ext (str): Mask file extension.
             num_classes (int): Number of classes.
             transform (Compose, optional): Compose transforms of albumentations. Defaults to None.
+            input_channels (int): 1 reads the images as grayscale, otherwise as 3-channel BGR.
         
         Note:
             Make sure to put the files as the following structure:
@@ -40,6 +44,7 @@ class Dataset(torch.utils.data.Dataset):
         self.mask_ext = mask_ext
         self.num_classes = num_classes
         self.transform = transform
+        self.input_channels = input_channels
 
     def __len__(self):
         return len(self.img_ids)
@@ -47,7 +52,10 @@ class Dataset(torch.utils.data.Dataset):
     def __getitem__(self, idx):
         img_id = self.img_ids[idx]
         
-        img = cv2.imread(os.path.join(self.img_dir, img_id + self.img_ext))
+        if self.input_channels == 1:
+            img = cv2.imread(os.path.join(self.img_dir, img_id + self.img_ext), cv2.IMREAD_GRAYSCALE)[..., None]
+        else:
+            img = cv2.imread(os.path.join(self.img_dir, img_id + self.img_ext))
 
         mask = []
         for i in range(self.num_classes):
@@ -65,3 +73,184 @@ class Dataset(torch.utils.data.Dataset):
         mask = mask.transpose(2, 0, 1)
         
         return img, mask, {'img_id': img_id}
+
+    def load_mask(self, idx):
+        """(num_classes, H, W) uint8 mask of sample idx, without transform."""
+        img_id = self.img_ids[idx]
+        return np.stack([cv2.imread(os.path.join(self.mask_dir, str(i), img_id + self.mask_ext), cv2.IMREAD_GRAYSCALE)
+                         for i in range(self.num_classes)])
+
+
+def source_signature(img_ids, img_dir, mask_dir, img_ext, mask_ext, num_classes):
+    """sha1 of the path, size and mtime of every source image and mask."""
+    h = hashlib.sha1()
+    for img_id in sorted(img_ids):
+        paths = [os.path.join(img_dir, img_id + img_ext)]
+        paths += [os.path.join(mask_dir, str(i), img_id + mask_ext) for i in range(num_classes)]
+        for path in paths:
+            st = os.stat(path)
+            h.update(('%s %d %d\n' % (path, st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def cache_is_valid(img_ids, img_dir, mask_dir, img_ext, mask_ext, num_classes, input_channels, cache_dir):
+    """True if cache_dir was built by build_cache from the same ids, channels,
+    classes and unchanged source files."""
+    ids_path = os.path.join(cache_dir, 'ids.txt')
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(ids_path) or not os.path.exists(meta_path):
+        return False
+    with open(ids_path) as f:
+        if sorted(f.read().split('\n')) != sorted(img_ids):
+            return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return (meta.get('input_channels') == input_channels
+            and meta.get('num_classes') == num_classes
+            and meta.get('sources') == source_signature(img_ids, img_dir, mask_dir, img_ext, mask_ext,
+                                                        num_classes))
+
+
+def build_cache(img_ids, img_dir, mask_dir, img_ext, mask_ext, num_classes, input_channels, cache_dir):
+    """Decode every image/mask once into contiguous uint8 arrays for CachedDataset.
+
+    Writes <cache_dir>/images.npy (N, input_channels, H, W),
+    <cache_dir>/masks.npy (N, num_classes, H, W), <cache_dir>/meta.json
+    (see cache_is_valid) and <cache_dir>/ids.txt.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # 先删除完成标志，重建中断时不会把写了一半的缓存当作有效
+    ids_path = os.path.join(cache_dir, 'ids.txt')
+    if os.path.exists(ids_path):
+        os.remove(ids_path)
+    flag = cv2.IMREAD_GRAYSCALE if input_channels == 1 else cv2.IMREAD_COLOR
+    first = cv2.imread(os.path.join(img_dir, img_ids[0] + img_ext), cv2.IMREAD_GRAYSCALE)
+    h, w = first.shape
+
+    images = np.lib.format.open_memmap(os.path.join(cache_dir, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(len(img_ids), input_channels, h, w))
+    masks = np.lib.format.open_memmap(os.path.join(cache_dir, 'masks.npy'), mode='w+',
+                                      dtype=np.uint8, shape=(len(img_ids), num_classes, h, w))
+    for idx, img_id in enumerate(img_ids):
+        img = cv2.imread(os.path.join(img_dir, img_id + img_ext), flag)
+        if img.ndim == 2:
+            img = img[..., None]
+        images[idx] = img.transpose(2, 0, 1)
+        for i in range(num_classes):
+            masks[idx, i] = cv2.imread(os.path.join(mask_dir, str(i), img_id + mask_ext), cv2.IMREAD_GRAYSCALE)
+    images.flush()
+    masks.flush()
+    del images, masks
+
+    meta = {
+        'input_channels': input_channels,
+        'num_classes': num_classes,
+        'height': h,
+        'width': w,
+        'sources': source_signature(img_ids, img_dir, mask_dir, img_ext, mask_ext, num_classes),
+    }
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    # ids.txt 最后写入，作为缓存构建完成的标志
+    with open(ids_path, 'w') as f:
+        f.write('\n'.join(img_ids))
+
+
+class CachedDataset(torch.utils.data.Dataset):
+    def __init__(self, img_ids, cache_dir):
+        """
+        Args:
+            img_ids (list): Image ids, all of them must be in the cache.
+            cache_dir: Directory written by build_cache.
+
+        Note:
+            Samples are uint8 views of the memory-mapped arrays, nothing is
+            decoded or converted per sample. Scale the collated batch with
+            .float() / 255 (see to_float), ideally after moving it to the device.
+        """
+        with open(os.path.join(cache_dir, 'ids.txt')) as f:
+            index = {img_id: idx for idx, img_id in enumerate(f.read().split('\n'))}
+        self.img_ids = img_ids
+        self.cache_dir = cache_dir
+        self.rows = [index[img_id] for img_id in img_ids]
+        # 在 __getitem__ 中才打开映射，spawn 出的 worker 不会序列化整个数组
+        self.images = None
+        self.masks = None
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            # copy-on-write 映射：样本是可写的视图，collate 时不会触发只读警告
+            self.images = np.load(os.path.join(self.cache_dir, 'images.npy'), mmap_mode='c')
+            self.masks = np.load(os.path.join(self.cache_dir, 'masks.npy'), mmap_mode='c')
+        row = self.rows[idx]
+        return self.images[row], self.masks[row], {'img_id': self.img_ids[idx]}
+
+    def load_mask(self, idx):
+        """(num_classes, H, W) uint8 mask of sample idx."""
+        return np.load(os.path.join(self.cache_dir, 'masks.npy'), mmap_mode='r')[self.rows[idx]]
+
+
+def foreground_box(mask):
+    """(y0, y1, x0, x1) inclusive bounding box of the nonzero pixels of a (C, H, W) mask, None if empty."""
+    fg = mask.max(axis=0) > 0
+    rows = np.flatnonzero(fg.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(fg.any(axis=0))
+    return rows[0], rows[-1], cols[0], cols[-1]
+
+
+class RandomCropDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset, crop_size, fg_ratio=0.5):
+        """
+        Args:
+            dataset: Dataset or CachedDataset.
+            crop_size (int): Side of the square crops, a multiple of 16.
+            fg_ratio (float): Share of crops centred inside the foreground
+                bounding box of the slice, the rest are placed uniformly.
+                Slices without foreground always get uniform crops.
+
+        Note:
+            Bounding boxes are computed once here from the masks, so only
+            the crop offset is drawn per sample.
+        """
+        self.dataset = dataset
+        self.crop_size = crop_size
+        self.fg_ratio = fg_ratio
+        self.boxes = [foreground_box(dataset.load_mask(idx)) for idx in range(len(dataset))]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        img, mask, meta = self.dataset[idx]
+        h, w = img.shape[1:]
+        size = self.crop_size
+        if h < size or w < size:
+            raise ValueError('crop_size %d is larger than the %dx%d slice %s' % (size, h, w, meta['img_id']))
+
+        box = self.boxes[idx]
+        if box is not None and np.random.rand() < self.fg_ratio:
+            # 以出血区域外接框内的随机点为中心，超出边界时平移回图像内
+            cy = np.random.randint(box[0], box[1] + 1)
+            cx = np.random.randint(box[2], box[3] + 1)
+            y = min(max(cy - size // 2, 0), h - size)
+            x = min(max(cx - size // 2, 0), w - size)
+        else:
+            y = np.random.randint(0, h - size + 1)
+            x = np.random.randint(0, w - size + 1)
+
+        img = np.ascontiguousarray(img[:, y:y + size, x:x + size])
+        mask = np.ascontiguousarray(mask[:, y:y + size, x:x + size])
+        return img, mask, meta
+
+
+def to_float(batch):
+    """Scale a uint8 batch from CachedDataset to float in [0, 1]; float batches pass through."""
+    if batch.dtype == torch.uint8:
+        return batch.float().div_(255)
+    return batch
@@ -0,0 +1,63 @@
+import argparse
+
+import torch
+
+from predict import load_config, load_model
+from utils import str2bool
+
+
+def parse_args(img_size=512):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--name', default='ICH' + str(img_size) + '_NestedUNet_woDS',
+                        help='model name')
+    parser.add_argument('--head', default=None, type=int,
+                        help='export only the NestedUNet sub-network of exit level L1-L<depth-1>')
+    parser.add_argument('--fuse', default=True, type=str2bool,
+                        help='fold BatchNorm into the convolutions before export')
+    parser.add_argument('--opset', default=17, type=int,
+                        help='ONNX opset version')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def export_onnx(model, path, config, opset=17):
+    """Write model to path as ONNX with dynamic batch and spatial axes.
+
+    The spatial size still has to be divisible by 16, the same as in torch.
+    """
+    dummy = torch.randn(1, config['input_channels'], config['input_h'], config['input_w'])
+    with torch.no_grad():
+        outputs = model(dummy)
+    if isinstance(outputs, (list, tuple)):
+        output_names = ['output%d' % (i + 1) for i in range(len(outputs))]
+    else:
+        output_names = ['output']
+
+    axes = {0: 'batch', 2: 'height', 3: 'width'}
+    dynamic_axes = {'input': axes}
+    for name in output_names:
+        dynamic_axes[name] = axes
+
+    torch.onnx.export(model, dummy, path,
+                      input_names=['input'],
+                      output_names=output_names,
+                      dynamic_axes=dynamic_axes,
+                      opset_version=opset)
+
+
+def main():
+    args = parse_args()
+    config = load_config(args.name)
+
+    model = load_model(config, torch.device('cpu'), args.head, args.fuse)
+
+    path = 'models/%s/model.onnx' % config['name']
+    export_onnx(model, path, config, args.opset)
+    print('=> exported %s' % path)
+
+
+if __name__ == '__main__':
+    main()
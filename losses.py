@@ -2,11 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-try:
-    from LovaszSoftmax.pytorch.lovasz_losses import lovasz_hinge
-except ImportError:
-    pass
-
 __all__ = ['BCEDiceLoss', 'LovaszHingeLoss']
 
 
@@ -15,6 +10,9 @@ class BCEDiceLoss(nn.Module):
         super().__init__()
 
     def forward(self, input, target):
+        # 在 float32 下计算，避免 autocast 时 dice 的求和在半精度下溢出
+        input = input.float()
+        target = target.float()
         bce = F.binary_cross_entropy_with_logits(input, target)
         smooth = 1e-5
         input = torch.sigmoid(input)
@@ -27,6 +25,55 @@ class BCEDiceLoss(nn.Module):
         return 0.5 * bce + dice
 
 
+def distillation_loss(input, teacher_output, temperature=1.0):
+    """Soft-target loss of knowledge distillation (Hinton et al. 2015): BCE
+    between the student logits and the teacher probabilities, both softened
+    by temperature, scaled by temperature ** 2 to keep gradients comparable."""
+    input = input.float() / temperature
+    soft_target = torch.sigmoid(teacher_output.float() / temperature)
+    return F.binary_cross_entropy_with_logits(input, soft_target) * temperature ** 2
+
+
+def lovasz_grad(gt_sorted):
+    """Gradient of the Lovasz extension of the Jaccard loss w.r.t. the sorted
+    errors, for every row of a (B, P) batch of sorted binary labels."""
+    gts = gt_sorted.sum(1, keepdim=True)
+    intersection = gts - gt_sorted.cumsum(1)
+    union = gts + (1 - gt_sorted).cumsum(1)
+    jaccard = 1. - intersection / union
+    jaccard[:, 1:] = jaccard[:, 1:] - jaccard[:, :-1]
+    return jaccard
+
+
+def lovasz_hinge(logits, labels, per_image=True):
+    """Binary Lovasz hinge loss (Berman et al. 2018).
+
+    Args:
+        logits: (N, H, W) logits.
+        labels: (N, H, W) binary masks.
+        per_image: Compute the loss per image and average, instead of over
+            all pixels of the batch at once.
+
+    All images are sorted and reduced as one (N, H*W) batch, there is no
+    Python loop over images.
+    """
+    logits = logits.float()
+    labels = labels.float()
+    if per_image:
+        logits = logits.reshape(logits.size(0), -1)
+        labels = labels.reshape(labels.size(0), -1)
+    else:
+        logits = logits.reshape(1, -1)
+        labels = labels.reshape(1, -1)
+    signs = 2. * labels - 1.
+    errors = 1. - logits * signs
+    errors_sorted, perm = torch.sort(errors, dim=1, descending=True)
+    # 标签只决定梯度的权重，不需要对其求导
+    grad = lovasz_grad(torch.gather(labels, 1, perm)).detach()
+    loss = (F.relu(errors_sorted) * grad).sum(1)
+    return loss.mean()
+
+
 class LovaszHingeLoss(nn.Module):
     def __init__(self):
         super().__init__()
@@ -1,50 +1,84 @@
-import numpy as np
+from collections import OrderedDict
+
 import torch
-import torch.nn.functional as F
+import torch.distributed as dist
 
 
-def iou_score(output, target):
-    smooth = 1e-5
+class MetricAccumulator(object):
+    """Accumulates TP/FP/FN of thresholded logits as device tensors.
 
-    if torch.is_tensor(output):
-        output = torch.sigmoid(output).data.cpu().numpy()
-    if torch.is_tensor(target):
-        target = target.data.cpu().numpy()
-    output_ = output > 0.5
-    target_ = target > 0.5
-    intersection = (output_ & target_).sum()
-    union = (output_ | target_).sum()
+    update() never leaves the device, so calling it every step costs no
+    host sync or logits copy; compute() syncs once and returns metrics of
+    the pooled counts rather than an average of per-batch scores.
+    """
 
-    return (intersection + smooth) / (union + smooth)
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.reset()
 
+    def reset(self):
+        self.counts = None
 
-def dice_coef(output, target):
-    smooth = 1e-5
+    def update(self, output, target):
+        with torch.no_grad():
+            output_ = torch.sigmoid(output) > self.threshold
+            target_ = target > 0.5
+            counts = torch.stack([(output_ & target_).sum(),
+                                  (output_ & ~target_).sum(),
+                                  (~output_ & target_).sum()])
+            if self.counts is None:
+                self.counts = counts
+            else:
+                self.counts += counts
+
+    def all_reduce(self):
+        # 分布式训练时汇总所有进程的计数；没有样本的进程也要参与 all_reduce
+        if self.counts is None:
+            device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+            self.counts = torch.zeros(3, dtype=torch.long, device=device)
+        dist.all_reduce(self.counts)
+
+    def compute(self, smooth=1e-5):
+        if self.counts is None:
+            tp, fp, fn = 0, 0, 0
+        else:
+            tp, fp, fn = self.counts.tolist()
+
+        def ratio(a, b):
+            if b + smooth == 0:
+                return float('nan')
+            return (a + smooth) / (b + smooth)
 
-    output = torch.sigmoid(output).view(-1).data.cpu().numpy()
-    target = target.view(-1).data.cpu().numpy()
-    output_ = output > 0.5
-    target_ = target > 0.5
-    intersection = (output_ * target_).sum()
+        precision = ratio(tp, tp + fp)
+        recall = ratio(tp, tp + fn)
+        if precision + recall:
+            f1 = 2 * precision * recall / (precision + recall)
+        else:
+            f1 = float('nan')
+        return OrderedDict([
+            ('precision', precision),
+            ('recall', recall),
+            ('f1', f1),
+            ('iou', ratio(tp, tp + fp + fn)),
+            ('dice', ratio(2 * tp, 2 * tp + fp + fn)),
+        ])
 
-    return (2. * intersection + smooth) / \
-        (output_.sum() + target_.sum() + smooth)
+
+def iou_score(output, target):
+    meter = MetricAccumulator()
+    meter.update(output, target)
+    return meter.compute()['iou']
+
+
+def dice_coef(output, target):
+    meter = MetricAccumulator()
+    meter.update(output, target)
+    return meter.compute()['dice']
 
 
 def metrics_all(pred, true):
-    output = torch.sigmoid(pred).view(-1).data.cpu().numpy()
-    target = true.view(-1).data.cpu().numpy()
-    output_ = output > 0.5
-    target_ = target > 0.5
-    tp = output_ & target_
-    fn = ((output_ == 0) & (target_ == 1)).astype('int')
-    fp = ((output_ == 1) & (target_ == 0)).astype('int')
-
-    precision = np.sum(tp) / (np.sum(tp) + np.sum(fp))
-    recall = np.sum(tp) / (np.sum(tp) + np.sum(fn))
-
-    f1 = 2 * precision * recall / (precision + recall)
-    iou = np.sum(tp) / (np.sum(tp) + np.sum(fp) + np.sum(fn))
-    dice = 2*np.sum(tp) / (2*np.sum(tp) + np.sum(fp) + np.sum(fn))
-
-    return float(precision), float(recall), float(f1), float(iou), float(dice)
\ No newline at end of file
+    meter = MetricAccumulator()
+    meter.update(pred, true)
+    result = meter.compute(smooth=0)
+
+    return result['precision'], result['recall'], result['f1'], result['iou'], result['dice']
@@ -0,0 +1,57 @@
+import torch
+from torch import nn
+
+__all__ = ['MixedPrecisionInference', 'mask_mismatch']
+
+
+def mask_mismatch(output, reference, threshold=0.5):
+    """Fraction of pixels whose thresholded masks differ between two logit maps."""
+    if isinstance(output, (list, tuple)):
+        output = output[-1]
+    if isinstance(reference, (list, tuple)):
+        reference = reference[-1]
+    output_ = torch.sigmoid(output) > threshold
+    reference_ = torch.sigmoid(reference) > threshold
+    return (output_ != reference_).float().mean().item()
+
+
+class MixedPrecisionInference(nn.Module):
+    """Run model in channels_last layout under autocast (bfloat16 by default).
+
+    On the first batch the masks are compared with a float32 pass of the same
+    model at the 0.5 threshold predict.py uses. If more than max_mismatch of
+    the pixels differ, autocast is switched off and the model keeps running
+    in float32.
+    """
+
+    def __init__(self, model, dtype=torch.bfloat16, channels_last=True, max_mismatch=1e-3):
+        super().__init__()
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        self.model = model
+        self.dtype = dtype
+        self.channels_last = channels_last
+        self.max_mismatch = max_mismatch
+        self.checked = False
+
+    def _forward(self, input, dtype):
+        if self.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(input.device.type, dtype=dtype, enabled=dtype is not None):
+            output = self.model(input)
+        if isinstance(output, (list, tuple)):
+            return [o.float() for o in output]
+        return output.float()
+
+    def forward(self, input):
+        output = self._forward(input, self.dtype)
+        if self.dtype is not None and not self.checked:
+            self.checked = True
+            reference = self._forward(input, None)
+            mismatch = mask_mismatch(output, reference)
+            print('=> %s mask mismatch against float32: %.6f' % (self.dtype, mismatch))
+            if mismatch > self.max_mismatch:
+                print('=> mismatch above %g, falling back to float32' % self.max_mismatch)
+                self.dtype = None
+                output = reference
+        return output
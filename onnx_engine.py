@@ -0,0 +1,23 @@
+import numpy as np
+import onnxruntime as ort
+
+
+class OnnxEngine(object):
+    """onnxruntime session for a models/<name>/model.onnx written by export.py.
+
+    Takes and returns numpy arrays and does not import torch, so inference
+    workers that only need the network can skip the torch start-up cost.
+    """
+
+    def __init__(self, path, num_threads=None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, input):
+        outputs = self.session.run(None, {self.input_name: np.ascontiguousarray(input, dtype=np.float32)})
+        # deep supervision 模型有多个输出，取最后一个 head
+        return outputs[-1]
@@ -1,5 +1,7 @@
 import argparse
 import os
+import time
+from collections import OrderedDict
 from glob import glob
 
 import cv2
@@ -12,11 +14,16 @@ import albumentations as albu
 from sklearn.model_selection import train_test_split
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+import nibabel as nib
 import numpy as np
 import archs
+from compile_cache import cache_key, compile_model
 from dataset import Dataset
-from metrics import iou_score, dice_coef, metrics_all
-from utils import AverageMeter
+from mixed_precision import MixedPrecisionInference
+from result_cache import CachedInference, ResultCache
+from sliding_window import SlidingWindowInference
+from metrics import MetricAccumulator
+from utils import AverageMeter, file_hash, str2bool
 
 
 def parse_args(img_size=512):
@@ -24,17 +31,171 @@ def parse_args(img_size=512):
 
     parser.add_argument('--name', default='ICH' + str(img_size) + '_NestedUNet_woDS',
                         help='model name')
+    parser.add_argument('--mode', default='slices', choices=['slices', 'volume'],
+                        help='slices: PNG slices under inputs/<dataset> | '
+                             'volume: NIfTI cases under --nii_dir (default: slices)')
+    parser.add_argument('-b', '--batch_size', default=None, type=int,
+                        help='inference batch size (default: batch_size in config.yml)')
+    parser.add_argument('--nii_dir', default='original_nii',
+                        help='NIfTI case directory (volume mode)')
+    parser.add_argument('--mask_nii_dir', default='mask_nii',
+                        help='output directory of <pid>.nii.gz masks (volume mode)')
+    parser.add_argument('--head', default=None, type=int,
+                        help='NestedUNet exit level L1-L<depth-1>, computes only the sub-network '
+                             'of that head (default: full network)')
+    parser.add_argument('--fuse', default=False, type=str2bool,
+                        help='fold BatchNorm into the convolutions before inference')
+    parser.add_argument('--dense_buffers', default=False, type=str2bool,
+                        help='NestedUNet: preallocated skip buffers instead of torch.cat')
+    parser.add_argument('--engine', default='torch', choices=['torch', 'onnxruntime'],
+                        help='inference backend, onnxruntime runs models/<name>/model.onnx '
+                             'written by export.py (default: torch)')
+    parser.add_argument('--int8', default=False, type=str2bool,
+                        help='run the int8 model exported by quantize.py (CPU only)')
+    parser.add_argument('--compile', default='none', choices=['none', 'torchscript', 'inductor'],
+                        help='compile the model and cache the artefact under '
+                             'models/<name>/compiled (default: none)')
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'],
+                        help='bf16 runs the forward pass under bfloat16 autocast (default: fp32)')
+    parser.add_argument('--channels_last', default=False, type=str2bool,
+                        help='convert the model and its inputs to torch.channels_last')
+    parser.add_argument('--max_mask_mismatch', default=1e-3, type=float,
+                        help='fall back to fp32 when more than this fraction of mask pixels '
+                             'differ from the fp32 reference on the first batch')
+    parser.add_argument('--tile_size', default=None, type=int,
+                        help='sliding-window tile size, divisible by 16 (default: whole slice)')
+    parser.add_argument('--tile_overlap', default=0.25, type=float,
+                        help='overlap ratio between neighbouring tiles')
+    parser.add_argument('--tile_window', default='gaussian', choices=['gaussian', 'linear'],
+                        help='window used to blend overlapping tile logits')
+    parser.add_argument('--cache', default=False, type=str2bool,
+                        help='reuse probability maps cached under models/<name>/cache')
+    parser.add_argument('--cache_size_mb', default=1024, type=int,
+                        help='disk budget of the result cache, LRU eviction above it')
 
     args = parser.parse_args()
 
     return args
 
 
-def main():
-    args = parse_args()
-    with open('models/%s/config.yml' % args.name, 'r') as f:
+def load_config(name):
+    with open('models/%s/config.yml' % name, 'r') as f:
         # config = yaml.load(f, Loader=yaml.FullLoader)
         config = yaml.load(f, Loader=yaml.SafeLoader)
+    return config
+
+
+def load_model(config, device, head=None, fuse=False, dense_buffers=False, int8=False,
+               engine='torch'):
+    """Create config['arch'], load models/<name>/model.pth and switch to eval.
+
+    head selects a NestedUNet deep-supervision exit (1-4) so that only the
+    sub-network feeding that head is computed. fuse folds every BatchNorm
+    into the preceding convolution (see archs.fuse_for_inference).
+    dense_buffers runs NestedUNet.forward_buffered to lower peak memory.
+    int8 loads models/<name>/model_int8.pt written by quantize.py instead.
+    engine='onnxruntime' runs models/<name>/model.onnx written by export.py.
+    """
+    if engine == 'onnxruntime':
+        from onnx_engine import OnnxEngine
+        session = OnnxEngine('models/%s/model.onnx' % config['name'])
+
+        def model(input):
+            return torch.from_numpy(session(input.cpu().numpy()))
+        return model
+
+    if int8:
+        # quantize.py 导出的 TorchScript int8 模型，只能在 CPU 上运行
+        model = torch.jit.load('models/%s/model_int8.pt' % config['name'], map_location='cpu')
+        model.eval()
+        return model
+
+    print("=> creating model %s" % config['arch'])
+    model = archs.__dict__[config['arch']](config['num_classes'],
+                                           config['input_channels'],
+                                           deep_supervision=config['deep_supervision'],
+                                           width_mult=config.get('width_mult', 1.0),
+                                           depth=config.get('depth', 5))
+    model.load_state_dict(torch.load('models/%s/model.pth' % config['name'], map_location=device))
+    if head is not None:
+        if not hasattr(model, 'exit_level'):
+            raise ValueError('%s has no deep-supervision heads' % config['arch'])
+        model.exit_level = head
+    if dense_buffers:
+        if not hasattr(model, 'dense_buffers'):
+            raise ValueError('%s has no dense skip connections' % config['arch'])
+        model.dense_buffers = True
+    model = model.to(device)
+    model.eval()
+    if fuse:
+        model = archs.fuse_for_inference(model)
+
+    return model
+
+
+def compute_output(model, input):
+    # deep supervision 返回各个 head 的列表，取最后一个
+    output = model(input)
+    if isinstance(output, (list, tuple)):
+        output = output[-1]
+    return output
+
+
+def train_val_split(config):
+    """Slice ids of config['dataset'] split like the default (--folds 0) train_woDS.py run."""
+    img_ids = glob(os.path.join('inputs', config['dataset'], 'images', '*' + config['img_ext']))
+    img_ids = [os.path.splitext(os.path.basename(p))[0] for p in img_ids]
+    return train_test_split(img_ids, test_size=0.2, random_state=41)
+
+
+def make_loader(config, img_ids, batch_size, shuffle=False):
+    dataset = Dataset(
+        img_ids=img_ids,
+        img_dir=os.path.join('inputs', config['dataset'], 'images'),
+        mask_dir=os.path.join('inputs', config['dataset'], 'masks'),
+        img_ext=config['img_ext'],
+        mask_ext=config['mask_ext'],
+        num_classes=config['num_classes'],
+        transform=None,
+        input_channels=config['input_channels'])
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=config['num_workers'],
+        drop_last=False)
+
+
+def evaluate(model, val_loader, device):
+    """Dice, IoU and latency per slice (ms) of model over val_loader."""
+    meter = MetricAccumulator()
+    latency = AverageMeter()
+
+    with torch.no_grad():
+        for input, target, _ in tqdm(val_loader, total=len(val_loader)):
+            input = input.to(device)
+            target = target.to(device)
+
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            output = compute_output(model, input)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+
+            meter.update(output, target)
+            latency.update(elapsed * 1000 / input.size(0), input.size(0))
+
+    result = meter.compute()
+    return OrderedDict([('dice', result['dice']),
+                        ('iou', result['iou']),
+                        ('latency_ms', latency.avg)])
+
+
+def main():
+    args = parse_args()
+    config = load_config(args.name)
 
     print('-' * 20)
     for key in config.keys():
@@ -43,13 +204,53 @@ def main():
 
     cudnn.benchmark = True
 
-    # create model
-    print("=> creating model %s" % config['arch'])
-    model = archs.__dict__[config['arch']](config['num_classes'],
-                                           config['input_channels'],
-                                           config['deep_supervision'])
+    cpu_only = args.int8 or args.engine == 'onnxruntime'
+    device = torch.device('cuda' if torch.cuda.is_available() and not cpu_only else 'cpu')
+    model = load_model(config, device, args.head, args.fuse, args.dense_buffers, args.int8,
+                       args.engine)
+
+    batch_size = args.batch_size or config['batch_size']
+
+    if args.compile != 'none':
+        if args.engine != 'torch' or args.int8:
+            raise ValueError('--compile only applies to the float torch engine')
+        key = cache_key(config, args.compile, args.head, args.fuse, args.dense_buffers)
+        model = compile_model(model, config, args.compile, device, key, batch_size)
+
+    if args.precision != 'fp32' or args.channels_last:
+        if args.engine != 'torch' or args.int8 or args.compile == 'torchscript':
+            raise ValueError('--precision/--channels_last need the eager or inductor torch engine')
+        dtype = torch.bfloat16 if args.precision == 'bf16' else None
+        model = MixedPrecisionInference(model, dtype, args.channels_last, args.max_mask_mismatch)
 
-    # model = model.cuda()
+    if args.tile_size is not None:
+        model = SlidingWindowInference(model, args.tile_size, args.tile_overlap,
+                                       args.tile_window, batch_size)
+
+    if args.cache:
+        if args.engine == 'onnxruntime':
+            checkpoint = 'models/%s/model.onnx' % config['name']
+        elif args.int8:
+            checkpoint = 'models/%s/model_int8.pt' % config['name']
+        else:
+            checkpoint = 'models/%s/model.pth' % config['name']
+        settings = {
+            'checkpoint': file_hash(checkpoint),
+            'threshold': 0.5,
+            'head': args.head,
+            'engine': args.engine,
+            'int8': args.int8,
+            'fuse': args.fuse,
+            'precision': args.precision,
+            'tile': [args.tile_size, args.tile_overlap, args.tile_window],
+        }
+        cache = ResultCache(os.path.join('models', config['name'], 'cache'), settings,
+                            args.cache_size_mb << 20)
+        model = CachedInference(model, cache)
+
+    if args.mode == 'volume':
+        predict_volumes(config, model, args.nii_dir, args.mask_nii_dir, batch_size, device)
+        return
 
     # Data loading code
     img_ids = glob(os.path.join('inputs', config['dataset'], 'images', '*' + config['img_ext']))            
@@ -57,64 +258,27 @@ def main():
     # _, val_img_ids = train_test_split(img_ids, test_size=0, random_state=41)   
     val_img_ids = img_ids 
 
-    
-    #model.load_state_dict(torch.load('models/%s/model.pth' % config['name']))
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model.load_state_dict(torch.load('models/%s/model.pth' % config['name'], map_location=device))
-    model.eval()
-
     # val_transform = Compose([
     #     albu.Resize(config['input_h'], config['input_w']),
     #     transforms.Normalize(),
     # ])
 
-    val_dataset = Dataset(
-        img_ids=val_img_ids,
-        img_dir=os.path.join('inputs', config['dataset'], 'images'),
-        mask_dir=os.path.join('inputs', config['dataset'], 'masks'),
-        img_ext=config['img_ext'],
-        mask_ext=config['mask_ext'],
-        num_classes=config['num_classes'],
-        transform=None)
-    val_loader = torch.utils.data.DataLoader(
-        val_dataset,
-        batch_size=config['batch_size'],
-        shuffle=False,
-        num_workers=config['num_workers'],
-        drop_last=False)
+    val_loader = make_loader(config, val_img_ids, batch_size)
 
-    avg_meter = AverageMeter()
-    avg_meter_dice = AverageMeter()
-    avg_meter_precision = AverageMeter()
-    avg_meter_recall = AverageMeter()
-    avg_meter_f1 = AverageMeter()
-    avg_meter_newdice = AverageMeter()
-    avg_meter_newiou = AverageMeter()
+    # 整个数据集的 TP/FP/FN 累加后再计算指标，而不是对每个 batch 的指标取平均
+    meter = MetricAccumulator()
 
     for c in range(config['num_classes']):
         os.makedirs(os.path.join('outputs', config['name'], str(c)), exist_ok=True)
     with torch.no_grad():
         for input, target, meta in tqdm(val_loader, total=len(val_loader)):
-            # input = input.cuda()
-            # target = target.cuda()
+            input = input.to(device)
+            target = target.to(device)
 
             # compute output
-            if config['deep_supervision']:
-                output = model(input)[-1]
-            else:
-                output = model(input)
-
-            iou = iou_score(output, target)
-            dice = dice_coef(output, target)
-            precision, recall, f1, new_iou, new_dice = metrics_all(output, target)
-            avg_meter.update(iou, input.size(0))
-            avg_meter_dice.update(dice, input.size(0))
-
-            avg_meter_precision.update(precision, input.size(0))
-            avg_meter_recall.update(recall, input.size(0))
-            avg_meter_f1.update(f1, input.size(0))
-            avg_meter_newdice.update(new_dice, input.size(0))
-            avg_meter_newiou.update(new_iou, input.size(0))
+            output = compute_output(model, input)
+
+            meter.update(output, target)
 
             output = torch.sigmoid(output).cpu().numpy()
             output = output > 0.5
@@ -124,18 +288,75 @@ def main():
                                 (output[i, c] * 255).astype('uint8'))
             # plot_examples(input, target, model, num_examples=3)
 
-    print('IoU: %.4f' % avg_meter.avg)
-    print('Dice: %.4f' % avg_meter_dice.avg)
+    result = meter.compute()
+    print('IoU: %.4f' % result['iou'])
+    print('Dice: %.4f' % result['dice'])
 
-    print('Precision: %.4f' % avg_meter_precision.avg)
-    print('Recall: %.4f' % avg_meter_recall.avg)
-    print('F1: %.4f' % avg_meter_f1.avg)
-    print('newDice: %.4f' % avg_meter_newdice.avg)
-    print('newIoU: %.4f' % avg_meter_newiou.avg)
+    print('Precision: %.4f' % result['precision'])
+    print('Recall: %.4f' % result['recall'])
+    print('F1: %.4f' % result['f1'])
+    if args.cache:
+        print('Cache hits: %d, misses: %d' % (model.hits, model.misses))
     
     torch.cuda.empty_cache()
 
 
+def load_nii_slices(path):
+    """Load a NIfTI case as uint8 axial slices (H, W, S), normalised per slice
+    the same way imageconver/nii_to_png.py builds the PNG inputs."""
+    img = nib.load(path)
+    data = np.asarray(img.dataobj, dtype=np.float32)
+    vmax = data.max(axis=(0, 1), keepdims=True)
+    vmax[vmax <= 0] = 1
+    slices = np.clip(data / vmax * 255.0, 0, 255).astype(np.uint8)
+    return slices, img
+
+
+def predict_volume(config, model, slices, batch_size, device):
+    """Segment every axial slice of a (H, W, S) uint8 volume in batches of
+    batch_size and return the uint8 (0/255) mask volume in the same layout."""
+    num_slices = slices.shape[-1]
+    mask = np.zeros(slices.shape + (config['num_classes'],), dtype=np.uint8)
+    with torch.no_grad():
+        for start in range(0, num_slices, batch_size):
+            stop = min(start + batch_size, num_slices)
+            batch = torch.from_numpy(np.ascontiguousarray(slices[:, :, start:stop].transpose(2, 0, 1)))
+            input = batch.to(device).float().div_(255).unsqueeze(1)
+            input = input.expand(-1, config['input_channels'], -1, -1)
+
+            output = compute_output(model, input)
+
+            output = (torch.sigmoid(output) > 0.5).to(torch.uint8).mul_(255)
+            mask[:, :, start:stop] = output.permute(2, 3, 0, 1).cpu().numpy()
+
+    if config['num_classes'] == 1:
+        mask = mask[..., 0]
+    return mask
+
+
+def predict_volumes(config, model, nii_dir, mask_nii_dir, batch_size, device):
+    """Run volume inference on every case under nii_dir and write
+    mask_nii_dir/<pid>.nii.gz with the affine of the source volume."""
+    nii_files = []
+    for dirpath, dirnames, filenames in os.walk(nii_dir):
+        for filename in filenames:
+            if filename.endswith(('.nii', '.nii.gz')):
+                nii_files.append(os.path.join(dirpath, filename))
+    nii_files.sort()
+
+    os.makedirs(mask_nii_dir, exist_ok=True)
+    for nii_file in tqdm(nii_files, total=len(nii_files)):
+        pid = os.path.basename(nii_file).split('.')[0]
+        slices, img = load_nii_slices(nii_file)
+        mask = predict_volume(config, model, slices, batch_size, device)
+
+        out = nib.Nifti1Image(mask, img.affine, header=img.header)
+        out.set_data_dtype(np.uint8)
+        nib.save(out, os.path.join(mask_nii_dir, pid + '.nii.gz'))
+
+    print('=> wrote %d mask volumes to %s' % (len(nii_files), mask_nii_dir))
+
+
 def plot_examples(datax, datay, model, num_examples=6):
     fig, ax = plt.subplots(nrows=num_examples, ncols=3, figsize=(18, 4 * num_examples))
     m = datax.shape[0]
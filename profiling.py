@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+
+import torch
+
+__all__ = ['StepTimer', 'PHASES']
+
+# train() 中一个 step 的各个阶段，对应 log.csv 中的 <phase>_ms 列
+PHASES = ['data', 'h2d', 'augment', 'forward', 'criterion', 'backward', 'step']
+
+
+class StepTimer(object):
+    """Wall time per phase of the training steps of one epoch.
+
+    lap(phase) charges the time since the previous lap to phase. On CUDA it
+    synchronizes first so that asynchronous kernels are charged to the phase
+    that launched them; this costs some overlap, so it can be disabled.
+    """
+
+    def __init__(self, device, enabled=True):
+        self.sync = enabled and device.type == 'cuda'
+        self.enabled = enabled
+        self.totals = OrderedDict((phase, 0.0) for phase in PHASES)
+        self.steps = 0
+        self.last = None
+
+    def reset(self):
+        if self.enabled:
+            if self.sync:
+                torch.cuda.synchronize()
+            self.last = time.perf_counter()
+
+    def lap(self, phase):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.totals[phase] += now - self.last
+        self.last = now
+        if phase == 'data':
+            self.steps += 1
+
+    def summary(self):
+        """Mean milliseconds per step of every phase, keyed '<phase>_ms'."""
+        steps = max(self.steps, 1)
+        value = (lambda t: t * 1000 / steps) if self.enabled else (lambda t: float('nan'))
+        return OrderedDict(('%s_ms' % phase, value(total)) for phase, total in self.totals.items())
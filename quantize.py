@@ -0,0 +1,96 @@
+import argparse
+import copy
+from collections import OrderedDict
+
+import pandas as pd
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from tqdm import tqdm
+
+from predict import evaluate, load_config, load_model, make_loader, train_val_split
+
+
+def parse_args(img_size=512):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--name', default='ICH' + str(img_size) + '_NestedUNet_woDS',
+                        help='model name')
+    parser.add_argument('--num_calib', default=300, type=int,
+                        help='number of training slices used for calibration')
+    parser.add_argument('--backend', default='x86', choices=['x86', 'fbgemm', 'qnnpack'],
+                        help='quantized engine (default: x86)')
+    parser.add_argument('-b', '--batch_size', default=None, type=int,
+                        help='batch size (default: batch_size in config.yml)')
+    parser.add_argument('--num_threads', default=None, type=int,
+                        help='torch CPU threads (default: torch default)')
+
+    args = parser.parse_args()
+
+    return args
+
+
+def quantize_static(model, calib_loader, backend='x86', num_calib=300):
+    """Post-training static int8 quantization of a float model.
+
+    Conv+BN+ReLU are fused, activation ranges are observed on num_calib
+    slices from calib_loader and the observed graph is converted to int8.
+    """
+    torch.backends.quantized.engine = backend
+    example, _, _ = next(iter(calib_loader))
+    model = copy.deepcopy(model).cpu().eval()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (example,))
+
+    seen = 0
+    with torch.no_grad():
+        for input, _, _ in tqdm(calib_loader, total=len(calib_loader)):
+            prepared(input)
+            seen += input.size(0)
+            if seen >= num_calib:
+                break
+
+    return convert_fx(prepared)
+
+
+def main():
+    args = parse_args()
+    config = load_config(args.name)
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    # 量化模型只能在 CPU 上运行
+    model = load_model(config, torch.device('cpu'))
+
+    train_img_ids, val_img_ids = train_val_split(config)
+    batch_size = args.batch_size or config['batch_size']
+    calib_loader = make_loader(config, train_img_ids, batch_size, shuffle=True)
+    val_loader = make_loader(config, val_img_ids, batch_size)
+
+    print('=> calibrating on %d slices' % min(args.num_calib, len(train_img_ids)))
+    qmodel = quantize_static(model, calib_loader, args.backend, args.num_calib)
+
+    log = OrderedDict([
+        ('model', []),
+        ('dice', []),
+        ('iou', []),
+        ('latency_ms', []),
+    ])
+    for label, m in [('float32', model), ('int8', qmodel)]:
+        print('=> evaluating %s' % label)
+        result = evaluate(m, val_loader, torch.device('cpu'))
+        log['model'].append(label)
+        log['dice'].append(result['dice'])
+        log['iou'].append(result['iou'])
+        log['latency_ms'].append(result['latency_ms'])
+
+    torch.jit.save(torch.jit.script(qmodel), 'models/%s/model_int8.pt' % config['name'])
+    print('=> saved models/%s/model_int8.pt' % config['name'])
+
+    log = pd.DataFrame(log)
+    log.to_csv('models/%s/quantization.csv' % config['name'], index=False)
+    print(log.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
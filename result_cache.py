@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from torch import nn
+
+__all__ = ['ResultCache', 'CachedInference']
+
+
+class ResultCache(object):
+    """Content-addressed store of probability maps with an LRU disk budget.
+
+    The key of a slice is a hash of its bytes and of settings (checkpoint
+    hash, threshold, head, engine, ...), so any change to the model or the
+    inference options misses the cache. Maps are stored as compressed
+    float16 .npz files; a hit refreshes the file mtime, and the least
+    recently used files are removed once max_bytes is exceeded.
+    """
+
+    def __init__(self, cache_dir, settings, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.prefix = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).digest()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(os.path.getsize(p) for p in self._files())
+
+    def _files(self):
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith('.npz'):
+                    yield os.path.join(dirpath, filename)
+
+    def _path(self, data):
+        key = hashlib.sha1(self.prefix + data).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def get(self, data):
+        path = self._path(data)
+        try:
+            with np.load(path) as f:
+                prob = f['prob']
+        except (OSError, KeyError, ValueError):
+            return None
+        os.utime(path)
+        return prob.astype(np.float32)
+
+    def put(self, data, prob):
+        path = self._path(data)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, prob=prob.astype(np.float16))
+        os.replace(tmp_path, path)
+        self.total_bytes += os.path.getsize(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        files = sorted(self._files(), key=os.path.getmtime)
+        self.total_bytes = sum(os.path.getsize(p) for p in files)
+        for path in files:
+            if self.total_bytes <= self.max_bytes:
+                break
+            self.total_bytes -= os.path.getsize(path)
+            os.remove(path)
+
+
+class CachedInference(nn.Module):
+    """Serve per-slice results of model from a ResultCache and only run the
+    model on the slices that miss. Returns logits like the wrapped model."""
+
+    def __init__(self, model, cache):
+        super().__init__()
+        self.model = model
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def forward(self, input):
+        keys = [np.ascontiguousarray(x).tobytes() for x in input.cpu().numpy()]
+        probs = [self.cache.get(key) for key in keys]
+        missing = [i for i, prob in enumerate(probs) if prob is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            output = self.model(input[missing])
+            if isinstance(output, (list, tuple)):
+                output = output[-1]
+            output = torch.sigmoid(output.float()).cpu().numpy()
+            for i, prob in zip(missing, output):
+                self.cache.put(keys[i], prob)
+                # 与缓存命中时的 float16 精度保持一致
+                probs[i] = prob.astype(np.float16).astype(np.float32)
+
+        prob = torch.from_numpy(np.stack(probs)).to(input.device)
+        return torch.logit(prob, eps=1e-6)
@@ -0,0 +1,89 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+
+__all__ = ['HardExampleSampler', 'per_sample_loss']
+
+
+def per_sample_loss(output, target):
+    """BCE + Dice of every sample of a batch, weighted like BCEDiceLoss, as a (N,) float32 tensor."""
+    output = output.detach().float()
+    target = target.float()
+    num = target.size(0)
+    bce = F.binary_cross_entropy_with_logits(output, target, reduction='none').view(num, -1).mean(1)
+    smooth = 1e-5
+    prob = torch.sigmoid(output).view(num, -1)
+    target = target.view(num, -1)
+    dice = (2. * (prob * target).sum(1) + smooth) / (prob.sum(1) + target.sum(1) + smooth)
+    return 0.5 * bce + 1 - dice
+
+
+class HardExampleSampler(torch.utils.data.Sampler):
+    def __init__(self, img_ids, empty, neg_rate=1.0, hard_weight=0.0, momentum=0.9, seed=41):
+        """
+        Args:
+            img_ids (list): Image ids of the dataset, in dataset order.
+            empty (list): True for the slices whose mask has no foreground.
+            neg_rate (float): Share of the empty slices drawn each epoch.
+            hard_weight (float): Online hard example mining strength. A slice
+                is drawn with probability proportional to
+                1 + hard_weight * loss / mean loss, with replacement; 0 keeps
+                a plain shuffle.
+            momentum (float): Exponential moving average of the per-sample
+                losses reported through update().
+            seed (int): Base seed, combined with the epoch from set_epoch().
+        """
+        self.index = {img_id: idx for idx, img_id in enumerate(img_ids)}
+        self.empty = np.asarray(empty, dtype=bool)
+        self.neg_rate = neg_rate
+        self.hard_weight = hard_weight
+        self.momentum = momentum
+        self.seed = seed
+        self.epoch = 0
+        # 还没有训练过的切片为 nan，取已知 loss 的均值
+        self.losses = np.full(len(img_ids), np.nan)
+
+    def __len__(self):
+        return int((~self.empty).sum()) + int(round(self.neg_rate * self.empty.sum()))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        positives = np.flatnonzero(~self.empty)
+        negatives = np.flatnonzero(self.empty)
+        negatives = rng.choice(negatives, int(round(self.neg_rate * len(negatives))), replace=False)
+        pool = np.concatenate([positives, negatives])
+
+        if self.hard_weight > 0 and not np.isnan(self.losses).all():
+            losses = self.losses[pool]
+            mean = np.nanmean(self.losses)
+            losses = np.where(np.isnan(losses), mean, losses)
+            weights = 1 + self.hard_weight * losses / max(mean, 1e-12)
+            indices = rng.choice(pool, len(pool), replace=True, p=weights / weights.sum())
+        else:
+            indices = rng.permutation(pool)
+        return iter(indices.tolist())
+
+    def update(self, img_ids, losses):
+        """Fold the per-sample losses of one epoch into the running averages."""
+        rows = np.array([self.index[img_id] for img_id in img_ids])
+        losses = np.asarray(losses, dtype=np.float64)
+        # 同一 epoch 中被重复抽到的切片依次更新
+        for row, loss in zip(rows, losses):
+            old = self.losses[row]
+            self.losses[row] = loss if np.isnan(old) else self.momentum * old + (1 - self.momentum) * loss
+
+    def report(self):
+        num_empty = int(self.empty.sum())
+        return ('epoch size %d of %d slices (%d with foreground, %d of %d empty, hard_weight %g)'
+                % (len(self), len(self.empty), len(self.empty) - num_empty,
+                   int(round(self.neg_rate * num_empty)), num_empty, self.hard_weight))
+
+    def state_dict(self):
+        return {'losses': self.losses.copy()}
+
+    def load_state_dict(self, state):
+        self.losses = state['losses'].copy()
@@ -0,0 +1,92 @@
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+__all__ = ['SlidingWindowInference']
+
+
+def blend_window(tile_h, tile_w, window='gaussian'):
+    """Weights used to blend overlapping tile logits, highest at the tile centre."""
+    def axis(n):
+        pos = torch.arange(n, dtype=torch.float32)
+        centre = (n - 1) / 2
+        if window == 'gaussian':
+            sigma = n / 8
+            return torch.exp(-(pos - centre) ** 2 / (2 * sigma ** 2))
+        elif window == 'linear':
+            return 1 - (pos - centre).abs() / (centre + 1)
+        else:
+            raise NotImplementedError
+
+    weight = axis(tile_h)[:, None] * axis(tile_w)[None, :]
+    weight = weight / weight.max()
+    return weight.clamp_(min=1e-4)
+
+
+def tile_starts(size, tile, stride):
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+    return starts
+
+
+class SlidingWindowInference(nn.Module):
+    """Run model on overlapping tiles of any input size and blend the logits.
+
+    Peak memory of the model is bounded by batch_size tiles of tile_size,
+    whatever the slice or mosaic size. Inputs smaller than a tile are
+    zero-padded. tile_size must be divisible by 16 for NestedUNet/UNet.
+    """
+
+    def __init__(self, model, tile_size=512, overlap=0.25, window='gaussian', batch_size=4):
+        super().__init__()
+        if isinstance(tile_size, int):
+            tile_size = (tile_size, tile_size)
+        if tile_size[0] % 16 or tile_size[1] % 16:
+            raise ValueError('tile_size must be divisible by 16, got %r' % (tile_size,))
+        if not 0 <= overlap < 1:
+            raise ValueError('overlap must be in [0, 1), got %r' % (overlap,))
+
+        self.model = model
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.register_buffer('window', blend_window(tile_size[0], tile_size[1], window), persistent=False)
+
+    def forward(self, input):
+        tile_h, tile_w = self.tile_size
+        n, _, h, w = input.shape
+        pad_h = max(tile_h - h, 0)
+        pad_w = max(tile_w - w, 0)
+        if pad_h or pad_w:
+            input = F.pad(input, (0, pad_w, 0, pad_h))
+        padded_h, padded_w = input.shape[2:]
+
+        stride_h = max(int(math.floor(tile_h * (1 - self.overlap))), 1)
+        stride_w = max(int(math.floor(tile_w * (1 - self.overlap))), 1)
+        tiles = [(b, y, x)
+                 for b in range(n)
+                 for y in tile_starts(padded_h, tile_h, stride_h)
+                 for x in tile_starts(padded_w, tile_w, stride_w)]
+
+        window = self.window.to(input.device)
+        logits = None
+        weight = input.new_zeros(1, 1, padded_h, padded_w)
+        for start in range(0, len(tiles), self.batch_size):
+            batch = tiles[start:start + self.batch_size]
+            output = self.model(torch.stack([input[b, :, y:y + tile_h, x:x + tile_w] for b, y, x in batch]))
+            if isinstance(output, (list, tuple)):
+                output = output[-1]
+            if logits is None:
+                logits = input.new_zeros(n, output.size(1), padded_h, padded_w)
+            output = output.float() * window
+            for k, (b, y, x) in enumerate(batch):
+                logits[b, :, y:y + tile_h, x:x + tile_w] += output[k]
+                if b == 0:
+                    weight[0, 0, y:y + tile_h, x:x + tile_w] += window
+
+        logits /= weight
+        return logits[:, :, :h, :w]
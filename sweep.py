@@ -0,0 +1,180 @@
+import argparse
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import pandas as pd
+import yaml
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Random search over train_woDS.py options with asynchronous successive '
+                    'halving (ASHA). Unknown arguments are passed on to every trial.')
+
+    parser.add_argument('--name', default='sweep',
+                        help='sweep name, trial i trains models/<name>_trial<i>')
+    parser.add_argument('--space', default='sweep.yml',
+                        help='search space yaml: a list of choices or {min, max, log} per option')
+    parser.add_argument('--num_trials', default=16, type=int)
+    parser.add_argument('--max_epochs', default=200, type=int,
+                        help='epochs of a trial that is never stopped')
+    parser.add_argument('--min_epochs', default=5, type=int,
+                        help='first rung: trials are compared after this many epochs')
+    parser.add_argument('--eta', default=3, type=int,
+                        help='reduction factor, only the top 1/eta of a rung continue')
+    parser.add_argument('--jobs', default=2, type=int,
+                        help='trials trained concurrently')
+    parser.add_argument('--threads', default=None, type=int,
+                        help='CPU threads per trial (default: cpu_count // jobs)')
+    parser.add_argument('--seed', default=41, type=int)
+
+    args, train_args = parser.parse_known_args()
+
+    return args, train_args
+
+
+def sample(space, rng):
+    params = OrderedDict()
+    for key, value in space.items():
+        if isinstance(value, list):
+            params[key] = rng.choice(value)
+        elif value.get('log', False):
+            params[key] = math.exp(rng.uniform(math.log(value['min']), math.log(value['max'])))
+        else:
+            params[key] = rng.uniform(value['min'], value['max'])
+    return params
+
+
+def rungs(min_epochs, max_epochs, eta):
+    """Epoch counts at which trials are compared: min_epochs * eta^k < max_epochs."""
+    result = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        result.append(epochs)
+        epochs *= eta
+    return result
+
+
+def read_log(name):
+    # 训练进程可能正在写 log.csv，读取失败时下次轮询再试
+    try:
+        return pd.read_csv('models/%s/log.csv' % name)
+    except (OSError, ValueError, pd.errors.EmptyDataError):
+        return None
+
+
+class Trial(object):
+    def __init__(self, index, name, params):
+        self.index = index
+        self.name = name
+        self.params = params
+        self.proc = None
+        self.stdout = None
+        self.status = 'pending'
+        self.epochs = 0
+        self.best_iou = float('nan')
+        self.rung = 0
+
+    def start(self, train_args, max_epochs, threads, env):
+        os.makedirs('models/%s' % self.name, exist_ok=True)
+        cmd = [sys.executable, 'train_woDS.py'] + train_args
+        for key, value in self.params.items():
+            cmd += ['--%s' % key, str(value)]
+        cmd += ['--name', self.name,
+                '--epochs', str(max_epochs),
+                '--num_threads', str(threads)]
+        self.stdout = open('models/%s/train.out' % self.name, 'w')
+        self.proc = subprocess.Popen(cmd, env=env, stdout=self.stdout, stderr=subprocess.STDOUT)
+        self.status = 'running'
+        print('=> trial %d: %s' % (self.index, ' '.join(cmd)))
+
+    def stop(self, status):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        self.stdout.close()
+        self.status = status
+
+
+def main():
+    args, train_args = parse_args()
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.jobs)
+
+    with open(args.space, 'r') as f:
+        space = yaml.load(f, Loader=yaml.SafeLoader)
+
+    rng = random.Random(args.seed)
+    trials = [Trial(i, '%s_trial%d' % (args.name, i), sample(space, rng))
+              for i in range(args.num_trials)]
+    milestones = rungs(args.min_epochs, args.max_epochs, args.eta)
+    # 每个 rung 上已记录的 best val_iou
+    records = [[] for _ in milestones]
+
+    env = dict(os.environ)
+    for key in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        env[key] = str(threads)
+
+    pending = list(trials)
+    running = []
+    while pending or running:
+        while pending and len(running) < args.jobs:
+            trial = pending.pop(0)
+            trial.start(train_args, args.max_epochs, threads, env)
+            running.append(trial)
+
+        for trial in list(running):
+            log = read_log(trial.name)
+            if log is not None and len(log):
+                trial.epochs = len(log)
+                trial.best_iou = log['val_iou'].max()
+
+            # 异步 successive halving：到达 rung 时与该 rung 已有的结果比较，
+            # 不在前 1/eta 的 trial 立即停止，不必等待同一批的其它 trial
+            while trial.rung < len(milestones) and trial.epochs >= milestones[trial.rung]:
+                record = records[trial.rung]
+                iou = log['val_iou'][:milestones[trial.rung]].max()
+                record.append(iou)
+                top = sorted(record, reverse=True)[:max(1, len(record) // args.eta)]
+                trial.rung += 1
+                if len(record) >= args.eta and iou < top[-1] and trial.proc.poll() is None:
+                    print('=> trial %d stopped at epoch %d (val_iou %.4f < %.4f)'
+                          % (trial.index, trial.epochs, iou, top[-1]))
+                    trial.stop('stopped')
+                    break
+
+            if trial.status == 'running' and trial.proc.poll() is not None:
+                trial.stop('completed' if trial.proc.returncode == 0 else 'failed')
+                print('=> trial %d %s after %d epochs' % (trial.index, trial.status, trial.epochs))
+            if trial.status != 'running':
+                running.remove(trial)
+        time.sleep(1)
+
+    leaderboard = OrderedDict([
+        ('trial', []),
+        ('status', []),
+        ('epochs', []),
+        ('best_val_iou', []),
+    ])
+    for key in space:
+        leaderboard[key] = []
+    for trial in trials:
+        leaderboard['trial'].append(trial.name)
+        leaderboard['status'].append(trial.status)
+        leaderboard['epochs'].append(trial.epochs)
+        leaderboard['best_val_iou'].append(trial.best_iou)
+        for key in space:
+            leaderboard[key].append(trial.params[key])
+
+    leaderboard = pd.DataFrame(leaderboard).sort_values('best_val_iou', ascending=False)
+    os.makedirs('models/%s' % args.name, exist_ok=True)
+    leaderboard.to_csv('models/%s/leaderboard.csv' % args.name, index=False)
+    print(leaderboard.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,51 @@
 import argparse
+import copy
 import os
+import random
+import time
 from collections import OrderedDict
 from glob import glob
 
+import numpy as np
 import pandas as pd
 import torch
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
 import yaml
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import GroupKFold, train_test_split
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import lr_scheduler
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 
 import archs
 import losses
-from dataset import Dataset
-from metrics import iou_score
-from utils import AverageMeter, str2bool
+from augment import BatchAugment
+from dataset import CachedDataset, Dataset, RandomCropDataset, build_cache, cache_is_valid, to_float
+from metrics import MetricAccumulator
+from profiling import PHASES, StepTimer
+from sampler import HardExampleSampler, per_sample_loss
+from utils import AsyncCheckpointer, AverageMeter, file_lock, str2bool
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 ARCH_NAMES = archs.__all__
 LOSS_NAMES = losses.__all__
 LOSS_NAMES.append('BCEWithLogitsLoss')
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# --amp 时 autocast 使用的精度：GPU 上 float16，CPU 上 bfloat16
+amp_dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+# 分布式训练时由 torchrun 的环境变量决定，单进程时为 0 / 1
+rank = 0
+world_size = 1
+# loss 在设备上累加，进度条每 POSTFIX_EVERY 个 step 才同步一次
+POSTFIX_EVERY = 20
 
 
 def parse_args(img_size=512):
@@ -43,6 +65,10 @@ def parse_args(img_size=512):
                              ' | '.join(ARCH_NAMES) +
                              ' (default: NestedUNet)')
     parser.add_argument('--deep_supervision', default=False, type=str2bool)
+    parser.add_argument('--width_mult', default=1.0, type=float,
+                        help='channel multiplier of UNet/NestedUNet (default: 1.0)')
+    parser.add_argument('--depth', default=5, type=int, choices=[2, 3, 4, 5],
+                        help='number of resolution levels of UNet/NestedUNet (default: 5)')
     parser.add_argument('--input_channels', default=1, type=int,
                         help='input channels')
     parser.add_argument('--num_classes', default=1, type=int,
@@ -59,6 +85,16 @@ def parse_args(img_size=512):
                              ' | '.join(LOSS_NAMES) +
                              ' (default: BCEDiceLoss)')
 
+    # distillation
+    parser.add_argument('--teacher', default=None,
+                        help='name of a trained model in models/ used as a frozen teacher; '
+                        'it must have the same input_channels and num_classes, and the student '
+                        'is usually narrower, e.g. --arch UNet --width_mult 0.5')
+    parser.add_argument('--distill_alpha', default=0.5, type=float,
+                        help='weight of the teacher soft targets, 1 - alpha goes to the mask loss')
+    parser.add_argument('--distill_temperature', default=2.0, type=float,
+                        help='temperature applied to teacher and student logits')
+
     # dataset
     parser.add_argument('--dataset', default='ICH' + str(img_size),
                         help='dataset name')
@@ -95,100 +131,350 @@ def parse_args(img_size=512):
                         metavar='N', help='early stopping (default: -1)')
 
     parser.add_argument('--num_workers', default=0, type=int)
+    parser.add_argument('--num_threads', default=None, type=int,
+                        help='torch CPU threads (default: torch default)')
+    parser.add_argument('--folds', default=0, type=int,
+                        help='patient-grouped k-fold split, 0 uses a random 80/20 slice split')
+    parser.add_argument('--fold', default=0, type=int,
+                        help='fold used for validation when --folds > 1')
+    parser.add_argument('--mmap_cache', default=False, type=str2bool,
+                        help='train from pre-decoded uint8 arrays in inputs/<dataset>/cache')
+    parser.add_argument('--crop_size', default=0, type=int,
+                        help='train on random square crops of this size, a multiple of 16 '
+                             '(0 trains on full slices); validation always uses full slices')
+    parser.add_argument('--fg_ratio', default=0.5, type=float,
+                        help='share of training crops centred on the foreground (default: 0.5)')
+    parser.add_argument('--augment', default=False, type=str2bool,
+                        help='random flips, rotation, elastic deformation and intensity jitter '
+                             'applied to each training batch on the device')
+    parser.add_argument('--step_timing', default=False, type=str2bool,
+                        help='log the mean time of every phase of a training step; synchronizes '
+                             'the GPU between phases, so it slows GPU training (default: False)')
+    parser.add_argument('--profile_steps', default='', type=str,
+                        help='write a torch.profiler trace of training steps start,end of the '
+                             'first epoch to models/<name>/trace.json, e.g. 10,20')
+    parser.add_argument('--neg_rate', default=1.0, type=float,
+                        help='share of slices without foreground drawn each epoch (default: 1.0)')
+    parser.add_argument('--hard_weight', default=0.0, type=float,
+                        help='online hard example mining: draw slices with probability '
+                             '1 + hard_weight * loss / mean loss (default: 0, plain shuffle)')
+    parser.add_argument('--amp', default=False, type=str2bool,
+                        help='automatic mixed precision (float16 + GradScaler on GPU, bfloat16 on CPU)')
+    parser.add_argument('--checkpoint_segments', default='none', type=str,
+                        help='recompute VGGBlock activations in backward: none | all | '
+                             'comma-separated resolution levels, e.g. 0,1 (default: none)')
+    parser.add_argument('--resume', default=False, type=str2bool,
+                        help='continue from models/<name>/checkpoint.pth')
+    parser.add_argument('--checkpoint_every', default=1, type=int,
+                        help='write a full checkpoint every N epochs (0 disables)')
+    parser.add_argument('--dist_backend', default='gloo', choices=['gloo', 'nccl'],
+                        help='torch.distributed backend when launched with torchrun (default: gloo)')
 
     config = parser.parse_args()
 
     return config
 
 
-def train(config, train_loader, model, criterion, optimizer):
-    avg_meters = {'loss': AverageMeter(),
-                  'iou': AverageMeter()}
+def peak_memory_mb():
+    # GPU 上统计显存峰值，CPU 上统计进程常驻内存峰值
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    if resource is None:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def all_reduce_log(log, ops):
+    """Combine the per-process epoch logs: 'mean' averages over processes
+    (every rank sees the same number of samples), 'sum' and 'max' reduce."""
+    if world_size == 1:
+        return log
+    values = torch.tensor([float(log[key]) for key in log], dtype=torch.float64)
+    summed = values.clone()
+    maxed = values.clone()
+    dist.all_reduce(summed, op=dist.ReduceOp.SUM)
+    dist.all_reduce(maxed, op=dist.ReduceOp.MAX)
+    reduced = OrderedDict()
+    for i, key in enumerate(log):
+        op = ops.get(key, 'mean')
+        if op == 'sum':
+            reduced[key] = summed[i].item()
+        elif op == 'max':
+            reduced[key] = maxed[i].item()
+        else:
+            reduced[key] = summed[i].item() / world_size
+    return reduced
+
+
+def create_model(config):
+    return archs.__dict__[config['arch']](config['num_classes'],
+                                          config['input_channels'],
+                                          deep_supervision=config['deep_supervision'],
+                                          width_mult=config.get('width_mult', 1.0),
+                                          depth=config.get('depth', 5))
+
+
+def load_teacher(name, config):
+    """Frozen model models/<name>/model.pth in eval mode."""
+    with open('models/%s/config.yml' % name, 'r') as f:
+        teacher_config = yaml.load(f, Loader=yaml.SafeLoader)
+    # soft target 按像素、按类别对齐，输入通道和类别数必须一致
+    for key in ['input_channels', 'num_classes']:
+        if teacher_config[key] != config[key]:
+            raise ValueError('teacher %s has %s=%s but the student has %s=%s'
+                             % (name, key, teacher_config[key], key, config[key]))
+    teacher = create_model(teacher_config)
+    teacher.load_state_dict(torch.load('models/%s/model.pth' % name, map_location=device))
+    teacher = teacher.to(device)
+    teacher.eval()
+    teacher.requires_grad_(False)
+    return teacher
+
+
+def benchmark_distillation(config, teacher, val_loader, num_latency=10):
+    """Validation Dice/IoU of the teacher and of the best student checkpoint,
+    and their CPU latency per slice on the first num_latency batches."""
+    student = create_model(config)
+    student.load_state_dict(torch.load('models/%s/model.pth' % config['name'], map_location=device))
+    student = student.to(device)
+    student.eval()
+
+    log = OrderedDict([
+        ('model', []),
+        ('params', []),
+        ('dice', []),
+        ('iou', []),
+        ('latency_ms', []),
+    ])
+    for label, model in [('teacher', teacher), ('student', student)]:
+        meter = MetricAccumulator()
+        latency = AverageMeter()
+        cpu_model = copy.deepcopy(model).cpu()
+        with torch.no_grad():
+            for i, (input, target, _) in enumerate(val_loader):
+                output = model(to_float(input.to(device)))
+                if isinstance(output, list):
+                    output = output[-1]
+                meter.update(output, to_float(target.to(device)))
+
+                # GUI 在 CPU 上推理，延迟按 CPU 计
+                if i < num_latency:
+                    input = to_float(input)
+                    start = time.perf_counter()
+                    cpu_model(input)
+                    latency.update((time.perf_counter() - start) * 1000 / input.size(0), input.size(0))
+        result = meter.compute()
+        log['model'].append('%s (%s)' % (label, config['teacher'] if label == 'teacher' else config['name']))
+        # teacher 的参数被冻结，不能用 count_params
+        log['params'].append(sum(p.numel() for p in model.parameters()))
+        log['dice'].append(result['dice'])
+        log['iou'].append(result['iou'])
+        log['latency_ms'].append(latency.avg)
+
+    log = pd.DataFrame(log)
+    log['speedup'] = log['latency_ms'][0] / log['latency_ms']
+    log.to_csv('models/%s/distillation.csv' % config['name'], index=False)
+    print(log.to_string(index=False))
+
+
+def train(config, train_loader, model, criterion, optimizer, scaler, sampler=None, trace_path=None,
+          teacher=None):
+    loss_sum = torch.zeros((), device=device)
+    # TP/FP/FN 留在设备上累加，epoch 结束时只同步一次
+    iou_meter = MetricAccumulator()
+    # 每个样本的 loss 同样留在设备上，epoch 结束时交给 sampler
+    sample_ids = []
+    sample_losses = []
+    # 增强在 collate 之后对整个 batch 做，不在 worker 中逐样本处理
+    augment = BatchAugment() if config['augment'] else None
+    timer = StepTimer(device, config['step_timing'])
+
+    profiler = None
+    if trace_path is not None:
+        profile_start, profile_end = [int(s) for s in config['profile_steps'].split(',')]
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+    profiling = False
 
     model.train()
 
-    pbar = tqdm(total=len(train_loader))
-    for input, target, _ in train_loader:
-        input = input.to(device)
-        target = target.to(device)
+    num_images = 0
+    start = time.perf_counter()
+    pbar = tqdm(total=len(train_loader), disable=rank != 0)
+    timer.reset()
+    for step, (input, target, meta) in enumerate(train_loader):
+        if profiler is not None and step == profile_start:
+            profiler.start()
+            profiling = True
+        timer.lap('data')
+
+        input = to_float(input.to(device))
+        target = to_float(target.to(device))
+        timer.lap('h2d')
+        if augment is not None:
+            input, target = augment(input, target)
+        timer.lap('augment')
 
         # compute output
-        if config['deep_supervision']:
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=config['amp']):
+            if teacher is not None:
+                with torch.no_grad():
+                    teacher_output = teacher(input)
+                if isinstance(teacher_output, list):
+                    teacher_output = teacher_output[-1]
             outputs = model(input)
-            loss = 0
-            for output in outputs:
-                loss += criterion(output, target)
-            loss /= len(outputs)
-            iou = iou_score(outputs[-1], target)
-        else:
-            output = model(input)
-            loss = criterion(output, target)
-            iou = iou_score(output, target)
+            timer.lap('forward')
+            if config['deep_supervision']:
+                loss = 0
+                for output in outputs:
+                    loss += criterion(output, target)
+                loss /= len(outputs)
+                output = outputs[-1]
+            else:
+                output = outputs
+                loss = criterion(output, target)
+            if teacher is not None:
+                # mask 上的 loss 与 teacher soft target 的 loss 加权
+                loss = (1 - config['distill_alpha']) * loss + config['distill_alpha'] * losses.distillation_loss(
+                    output, teacher_output, config['distill_temperature'])
+        # 指标的累加也计入 criterion
+        iou_meter.update(output, target)
+        if sampler is not None:
+            sample_ids.extend(meta['img_id'])
+            sample_losses.append(per_sample_loss(output, target))
+        timer.lap('criterion')
 
         # compute gradient and do optimizing step
         optimizer.zero_grad()  # 梯度归零
-        loss.backward()  # 反向传播计算得到每个参数的梯度值
-        optimizer.step()  # 参数更新
-
-        avg_meters['loss'].update(loss.item(), input.size(0))
-        avg_meters['iou'].update(iou, input.size(0))
-
-        postfix = OrderedDict([
-            ('loss', avg_meters['loss'].avg),
-            ('iou', avg_meters['iou'].avg),
-        ])
-        pbar.set_postfix(postfix)
+        scaler.scale(loss).backward()  # 反向传播计算得到每个参数的梯度值
+        timer.lap('backward')
+        scaler.step(optimizer)  # 参数更新
+        scaler.update()
+        timer.lap('step')
+
+        if profiling and step + 1 == profile_end:
+            profiler.stop()
+            profiler.export_chrome_trace(trace_path)
+            print('=> wrote profiler trace %s' % trace_path)
+            profiling = False
+
+        num_images += input.size(0)
+        loss_sum += loss.detach().float() * input.size(0)
+
+        if rank == 0 and ((step + 1) % POSTFIX_EVERY == 0 or step + 1 == len(train_loader)):
+            postfix = OrderedDict([
+                ('loss', loss_sum.item() / num_images),
+            ])
+            pbar.set_postfix(postfix)
         pbar.update(1)
+        # 进度条等记录开销不计入下一个 step 的 data
+        timer.reset()
     pbar.close()
 
-    return OrderedDict([('loss', avg_meters['loss'].avg),('iou', avg_meters['iou'].avg)])
+    if profiling:
+        # epoch 的 step 数少于 profile_steps 的结束位置
+        profiler.stop()
+        profiler.export_chrome_trace(trace_path)
+        print('=> wrote profiler trace %s' % trace_path)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    throughput = num_images / (time.perf_counter() - start)
+
+    if world_size > 1:
+        iou_meter.all_reduce()
+
+    if sampler is not None and sample_ids:
+        sampler.update(sample_ids, torch.cat(sample_losses).cpu().numpy())
+
+    result = OrderedDict([('loss', loss_sum.item() / max(num_images, 1)),
+                          ('iou', iou_meter.compute()['iou']),
+                          ('throughput', throughput),
+                          ('epoch_size', num_images)])
+    result.update(timer.summary())
+    return result
 
 
 def validate(config, val_loader, model, criterion):
-    avg_meters = {'loss': AverageMeter(),
-                  'iou': AverageMeter()}
+    loss_sum = torch.zeros((), device=device)
+    num_images = 0
+    # TP/FP/FN 留在设备上累加，epoch 结束时只同步一次
+    iou_meter = MetricAccumulator()
 
     # switch to evaluate mode
     model.eval()
 
     with torch.no_grad():
-        pbar = tqdm(total=len(val_loader))
-        for input, target, _ in val_loader:
-            input = input.to(device)
-            target = target.to(device)
+        pbar = tqdm(total=len(val_loader), disable=rank != 0)
+        for step, (input, target, _) in enumerate(val_loader):
+            input = to_float(input.to(device))
+            target = to_float(target.to(device))
 
             # compute output
-            if config['deep_supervision']:
-                outputs = model(input)
-                loss = 0
-                for output in outputs:
-                    loss += criterion(output, target)
-                loss /= len(outputs)
-                iou = iou_score(outputs[-1], target)
-            else:
-                output = model(input)
-                loss = criterion(output, target)
-                iou = iou_score(output, target)
-
-            avg_meters['loss'].update(loss.item(), input.size(0))
-            avg_meters['iou'].update(iou, input.size(0))
-
-            postfix = OrderedDict([
-                ('loss', avg_meters['loss'].avg),
-                ('iou', avg_meters['iou'].avg),
-            ])
-            pbar.set_postfix(postfix)
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=config['amp']):
+                if config['deep_supervision']:
+                    outputs = model(input)
+                    loss = 0
+                    for output in outputs:
+                        loss += criterion(output, target)
+                    loss /= len(outputs)
+                    output = outputs[-1]
+                else:
+                    output = model(input)
+                    loss = criterion(output, target)
+            iou_meter.update(output, target)
+
+            num_images += input.size(0)
+            loss_sum += loss.detach().float() * input.size(0)
+
+            if rank == 0 and ((step + 1) % POSTFIX_EVERY == 0 or step + 1 == len(val_loader)):
+                postfix = OrderedDict([
+                    ('loss', loss_sum.item() / num_images),
+                ])
+                pbar.set_postfix(postfix)
             pbar.update(1)
         pbar.close()
 
-    return OrderedDict([('loss', avg_meters['loss'].avg),
-                        ('iou', avg_meters['iou'].avg)])
+    totals = torch.stack([loss_sum.double(), torch.tensor(float(num_images), dtype=torch.float64, device=device)])
+    if world_size > 1:
+        iou_meter.all_reduce()
+        # 各进程的验证样本数可能差一个，按样本数加权汇总 loss
+        totals = totals.to(device if config['dist_backend'] == 'nccl' else 'cpu')
+        dist.all_reduce(totals)
+    loss_total, count = totals.tolist()
+    loss = loss_total / max(count, 1)
+
+    return OrderedDict([('loss', loss),
+                        ('iou', iou_meter.compute()['iou'])])
 
 
 def main():
+    global device, rank, world_size
+
     # vars() 函数返回对象object的属性和属性值的字典对象
     config = vars(parse_args())
 
+    if config['folds'] == 1 or config['folds'] < 0:
+        raise ValueError('--folds must be 0 (random split) or at least 2, got %d' % config['folds'])
+    if config['folds'] > 1 and not 0 <= config['fold'] < config['folds']:
+        raise ValueError('--fold must be in [0, %d), got %d' % (config['folds'], config['fold']))
+
+    if config['num_threads'] is not None:
+        torch.set_num_threads(config['num_threads'])
+
+    # torchrun --nproc_per_node=N train_woDS.py ... 启动多进程（可跨节点）训练
+    distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    if distributed:
+        dist.init_process_group(backend=config['dist_backend'])
+        rank = dist.get_rank()
+        world_size = dist.get_world_size()
+        if device.type == 'cuda':
+            local_rank = int(os.environ.get('LOCAL_RANK', 0))
+            torch.cuda.set_device(local_rank)
+            device = torch.device('cuda', local_rank)
+
     if config['name'] is None:
         if config['deep_supervision']:
             config['name'] = '%s_%s_wDS' % (config['dataset'], config['arch'])
@@ -196,13 +482,14 @@ def main():
             config['name'] = '%s_%s_woDS' % (config['dataset'], config['arch'])
     os.makedirs('models/%s' % config['name'], exist_ok=True)
 
-    print('-' * 20)
-    for key in config:
-        print('%s: %s' % (key, config[key]))
-    print('-' * 20)
+    if rank == 0:
+        print('-' * 20)
+        for key in config:
+            print('%s: %s' % (key, config[key]))
+        print('-' * 20)
 
-    with open('models/%s/config.yml' % config['name'], 'w') as f:
-        yaml.dump(config, f)
+        with open('models/%s/config.yml' % config['name'], 'w') as f:
+            yaml.dump(config, f)
 
     # define loss function (criterion)
     if config['loss'] == 'BCEWithLogitsLoss':
@@ -214,10 +501,28 @@ def main():
 
     # create model
     print("=> creating model %s" % config['arch'])
-    model = archs.__dict__[config['arch']](config['num_classes'],config['input_channels'],config['deep_supervision'])
+    model = create_model(config)
 
     model = model.to(device)
 
+    teacher = None
+    if config['teacher'] is not None:
+        if rank == 0:
+            print('=> distilling from teacher %s' % config['teacher'])
+            if config['arch'] != 'UNet' or config['width_mult'] >= 1:
+                print('=> warning: the student is not narrower than the default model, '
+                      'use e.g. --arch UNet --width_mult 0.5 for a smaller student')
+        teacher = load_teacher(config['teacher'], config)
+
+    if config['checkpoint_segments'] != 'none':
+        levels = config['checkpoint_segments']
+        if levels != 'all':
+            levels = [int(level) for level in levels.split(',')]
+        archs.set_checkpointing(model, levels)
+
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+
     params = filter(lambda p: p.requires_grad, model.parameters())
     if config['optimizer'] == 'Adam':
         optimizer = optim.Adam(
@@ -244,34 +549,95 @@ def main():
     # Data loading code
     img_ids = glob(os.path.join('inputs', config['dataset'], 'images', '*' + config['img_ext']))
     img_ids = [os.path.splitext(os.path.basename(p))[0] for p in img_ids]
-    
-    train_img_ids, val_img_ids = train_test_split(img_ids, test_size=0.2, random_state=41)   
-
-    train_dataset = Dataset(
-        img_ids=train_img_ids,
-        img_dir=os.path.join('inputs', config['dataset'], 'images'),
-        mask_dir=os.path.join('inputs', config['dataset'], 'masks'),
-        img_ext=config['img_ext'],
-        mask_ext=config['mask_ext'],
-        num_classes=config['num_classes'],
-        transform=None)
-    val_dataset = Dataset(
-        img_ids=val_img_ids,
-        img_dir=os.path.join('inputs', config['dataset'], 'images'),
-        mask_dir=os.path.join('inputs', config['dataset'], 'masks'),
-        img_ext=config['img_ext'],
-        mask_ext=config['mask_ext'],
-        num_classes=config['num_classes'],
-        transform=None)
+    if distributed or config['folds'] > 1:
+        # 不同节点上 glob 的顺序可能不同，排序后各进程得到相同的划分
+        img_ids = sorted(img_ids)
+
+    if config['folds'] > 1:
+        # 按病人划分（id 前缀，如 049_14 -> 049），同一病人的切片不会同时出现在训练集和验证集
+        groups = [img_id.split('_')[0] for img_id in img_ids]
+        splits = list(GroupKFold(n_splits=config['folds']).split(img_ids, groups=groups))
+        train_idx, val_idx = splits[config['fold']]
+        train_img_ids = [img_ids[i] for i in train_idx]
+        val_img_ids = [img_ids[i] for i in val_idx]
+    else:
+        train_img_ids, val_img_ids = train_test_split(img_ids, test_size=0.2, random_state=41)
+
+    if config['mmap_cache']:
+        cache_dir = os.path.join('inputs', config['dataset'], 'cache')
+        cache_args = dict(img_dir=os.path.join('inputs', config['dataset'], 'images'),
+                          mask_dir=os.path.join('inputs', config['dataset'], 'masks'),
+                          img_ext=config['img_ext'],
+                          mask_ext=config['mask_ext'],
+                          num_classes=config['num_classes'],
+                          input_channels=config['input_channels'],
+                          cache_dir=cache_dir)
+        # id、通道数、类别数或源文件（大小 / 修改时间）变化时重建
+        if rank == 0:
+            # cross_validate.py / sweep.py 的并行进程共用同一个缓存：加锁后再检查，只有第一个进程重建，
+            # 其余进程等待重建完成后直接使用
+            with file_lock(os.path.join('inputs', config['dataset'], 'cache.lock')):
+                if not cache_is_valid(img_ids, **cache_args):
+                    print('=> building memory-mapped cache %s' % cache_dir)
+                    build_cache(sorted(img_ids), **cache_args)
+        if distributed:
+            dist.barrier()
+        train_dataset = CachedDataset(train_img_ids, cache_dir)
+        val_dataset = CachedDataset(val_img_ids, cache_dir)
+    else:
+        train_dataset = Dataset(
+            img_ids=train_img_ids,
+            img_dir=os.path.join('inputs', config['dataset'], 'images'),
+            mask_dir=os.path.join('inputs', config['dataset'], 'masks'),
+            img_ext=config['img_ext'],
+            mask_ext=config['mask_ext'],
+            num_classes=config['num_classes'],
+            transform=None,
+            input_channels=config['input_channels'])
+        val_dataset = Dataset(
+            img_ids=val_img_ids,
+            img_dir=os.path.join('inputs', config['dataset'], 'images'),
+            mask_dir=os.path.join('inputs', config['dataset'], 'masks'),
+            img_ext=config['img_ext'],
+            mask_ext=config['mask_ext'],
+            num_classes=config['num_classes'],
+            transform=None,
+            input_channels=config['input_channels'])
+
+    if config['crop_size'] > 0:
+        if config['crop_size'] % 16 != 0:
+            raise ValueError('crop_size must be a multiple of 16, got %d' % config['crop_size'])
+        train_dataset = RandomCropDataset(train_dataset, config['crop_size'], config['fg_ratio'])
+
+    # 分布式时每个进程只加载 train_img_ids / val_img_ids 的一个分片，batch_size 为每个进程的大小
+    train_sampler = DistributedSampler(train_dataset, shuffle=True, drop_last=True) if distributed else None
+    hard_sampler = None
+    if config['neg_rate'] < 1 or config['hard_weight'] > 0:
+        if distributed:
+            raise ValueError('--neg_rate / --hard_weight are not supported with distributed training')
+        if isinstance(train_dataset, RandomCropDataset):
+            empty = [box is None for box in train_dataset.boxes]
+        else:
+            empty = [not train_dataset.load_mask(i).any() for i in range(len(train_dataset))]
+        hard_sampler = HardExampleSampler(train_img_ids, empty, config['neg_rate'], config['hard_weight'])
+        train_sampler = hard_sampler
+        if rank == 0:
+            print('=> ' + hard_sampler.report())
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=config['batch_size'],
-        shuffle=True,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
         num_workers=config['num_workers'],
         drop_last=True)
+    # DistributedSampler 会重复样本补齐到 world_size 的整数倍，验证集改为不补齐地按 rank 切分，
+    # 汇总后的 val_iou 与单进程训练完全一致
+    val_shard = val_dataset
+    if distributed:
+        val_shard = torch.utils.data.Subset(val_dataset, range(rank, len(val_dataset), world_size))
     val_loader = torch.utils.data.DataLoader(
-        val_dataset,
+        val_shard,
         batch_size=config['batch_size'],
         shuffle=False,
         num_workers=config['num_workers'],
@@ -284,25 +650,80 @@ def main():
         ('iou', []),
         ('val_loss', []),
         ('val_iou', []),
+        ('throughput', []),
+        ('epoch_size', []),
+        ('peak_mem_mb', []),
     ])
+    for phase in PHASES:
+        log['%s_ms' % phase] = []
+
+    # GradScaler 只在 GPU float16 下需要，其他情况下是直通的
+    scaler = torch.amp.GradScaler(device.type, enabled=config['amp'] and device.type == 'cuda')
 
     best_iou = 0
     trigger = 0
-    for epoch in range(config['epochs']):
-        print('Epoch [%d/%d]' % (epoch, config['epochs']))
+    start_epoch = 0
+    checkpoint_path = 'models/%s/checkpoint.pth' % config['name']
+    raw_model = model.module if distributed else model
+    if config['resume']:
+        checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=False)
+        raw_model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        if scheduler is not None:
+            scheduler.load_state_dict(checkpoint['scheduler'])
+        scaler.load_state_dict(checkpoint['scaler'])
+        if hard_sampler is not None and checkpoint.get('sampler') is not None:
+            hard_sampler.load_state_dict(checkpoint['sampler'])
+        best_iou = checkpoint['best_iou']
+        trigger = checkpoint['trigger']
+        # 旧 checkpoint 中缺少的列补 nan
+        for key in log:
+            log[key] = checkpoint['log'].get(key, [float('nan')] * len(checkpoint['log']['epoch']))
+        start_epoch = checkpoint['epoch'] + 1
+        torch.set_rng_state(checkpoint['rng']['torch'])
+        if torch.cuda.is_available() and checkpoint['rng']['cuda'] is not None:
+            torch.cuda.set_rng_state_all(checkpoint['rng']['cuda'])
+        np.random.set_state(checkpoint['rng']['numpy'])
+        random.setstate(checkpoint['rng']['python'])
+        if rank == 0:
+            print('=> resumed from %s (epoch %d)' % (checkpoint_path, checkpoint['epoch']))
+    checkpointer = AsyncCheckpointer()
+
+    for epoch in range(start_epoch, config['epochs']):
+        if rank == 0:
+            print('Epoch [%d/%d]' % (epoch, config['epochs']))
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
 
         # train for one epoch
-        train_log = train(config, train_loader, model, criterion, optimizer)
+        trace_path = None
+        if config['profile_steps'] and epoch == start_epoch and rank == 0:
+            trace_path = 'models/%s/trace.json' % config['name']
+        train_log = train(config, train_loader, model, criterion, optimizer, scaler, hard_sampler, trace_path,
+                          teacher)
         # evaluate on validation set
         val_log = validate(config, val_loader, model, criterion)
 
+        # 所有进程得到相同的指标，早停和最优模型的判断因此保持同步
+        train_log = all_reduce_log(train_log, {'throughput': 'sum', 'epoch_size': 'sum'})
+        val_log = all_reduce_log(val_log, {})
+        peak_mem = all_reduce_log(OrderedDict([('peak_mem_mb', peak_memory_mb())]),
+                                  {'peak_mem_mb': 'max'})['peak_mem_mb']
+
         if config['scheduler'] == 'CosineAnnealingLR':
             scheduler.step()
         elif config['scheduler'] == 'ReduceLROnPlateau':
             scheduler.step(val_log['loss'])
 
-        print('loss %.4f - iou %.4f - val_loss %.4f - val_iou %.4f'
-              % (train_log['loss'], train_log['iou'], val_log['loss'], val_log['iou']))
+        if rank == 0:
+            print('loss %.4f - iou %.4f - val_loss %.4f - val_iou %.4f - %.1f img/s - peak mem %.0f MB'
+                  % (train_log['loss'], train_log['iou'], val_log['loss'], val_log['iou'],
+                     train_log['throughput'], peak_mem))
+            if config['step_timing']:
+                print('step ms: ' + ' - '.join('%s %.1f' % (phase, train_log['%s_ms' % phase])
+                                               for phase in PHASES))
 
         log['epoch'].append(epoch)
         log['lr'].append(config['lr'])
@@ -310,26 +731,71 @@ def main():
         log['iou'].append(train_log['iou'])
         log['val_loss'].append(val_log['loss'])
         log['val_iou'].append(val_log['iou'])
+        log['throughput'].append(train_log['throughput'])
+        log['epoch_size'].append(train_log['epoch_size'])
+        log['peak_mem_mb'].append(peak_mem)
+        for phase in PHASES:
+            log['%s_ms' % phase].append(train_log['%s_ms' % phase])
 
-        pd.DataFrame(log).to_csv('models/%s/log.csv' %
-                                 config['name'], index=False)
+        if rank == 0:
+            pd.DataFrame(log).to_csv('models/%s/log.csv' %
+                                     config['name'], index=False)
 
         trigger += 1
 
         if val_log['iou'] > best_iou:
-            torch.save(model.state_dict(), 'models/%s/model.pth' %
-                       config['name'])
+            if rank == 0:
+                # DDP 时保存内部模型，保证 model.pth 与单进程训练的格式一致
+                torch.save(raw_model.state_dict(), 'models/%s/model.pth' %
+                           config['name'])
+                print("=> saved best model")
             best_iou = val_log['iou']
-            print("=> saved best model")
             trigger = 0
 
+        # 完整的训练状态，--resume 时从下一个 epoch 继续
+        if rank == 0 and config['checkpoint_every'] > 0 and (epoch + 1) % config['checkpoint_every'] == 0:
+            checkpointer.save({
+                'epoch': epoch,
+                'model': raw_model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict() if scheduler is not None else None,
+                'scaler': scaler.state_dict(),
+                'sampler': hard_sampler.state_dict() if hard_sampler is not None else None,
+                'best_iou': best_iou,
+                'trigger': trigger,
+                'log': log,
+                'rng': {
+                    'torch': torch.get_rng_state(),
+                    'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                    'numpy': np.random.get_state(),
+                    'python': random.getstate(),
+                },
+                'config': config,
+            }, checkpoint_path)
+
         # early stopping
         if config['early_stopping'] >= 0 and trigger >= config['early_stopping']:
-            print("=> early stopping")
+            if rank == 0:
+                print("=> early stopping")
             break
 
         torch.cuda.empty_cache()  # 清空显存缓冲区
 
+    checkpointer.wait()
+
+    if teacher is not None and rank == 0:
+        print('=> comparing teacher %s and student %s' % (config['teacher'], config['name']))
+        # 分布式时 val_loader 只含本进程的分片，对比用完整的验证集
+        benchmark_distillation(config, teacher, torch.utils.data.DataLoader(
+            val_dataset,
+            batch_size=config['batch_size'],
+            shuffle=False,
+            num_workers=config['num_workers'],
+            drop_last=False))
+
+    if distributed:
+        dist.destroy_process_group()
+
 
 if __name__ == '__main__':
     main()
@@ -1,4 +1,18 @@
 import argparse
+import contextlib
+import hashlib
+import os
+import threading
+import time
+
+import torch
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 上没有 fcntl，用 msvcrt 加锁
+    fcntl = None
+    import msvcrt
 
 
 def str2bool(v):
@@ -10,6 +24,40 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
+@contextlib.contextmanager
+def file_lock(path):
+    """Exclusive lock between processes on the file path (created if missing).
+
+    The lock is held by the open file, so the OS releases it if the process dies.
+    """
+    with open(path, 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def file_hash(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
 def count_params(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
 
@@ -31,3 +79,52 @@ class AverageMeter(object):
         self.sum += val * n
         self.count += n
         self.avg = self.sum / self.count
+
+
+
+def to_cpu(obj):
+    """Deep copy of a (nested) state dict with every tensor cloned to the CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+class AsyncCheckpointer(object):
+    """Writes checkpoints atomically from a background thread.
+
+    An error of the write is raised again from the next wait(), i.e. before
+    the next save() and when training ends.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, state, path):
+        # 在主线程里拷贝到 CPU，之后训练可以继续修改参数
+        state = to_cpu(state)
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state, path), daemon=True)
+        self.thread.start()
+
+    def _write(self, state, path):
+        tmp_path = path + '.tmp'
+        try:
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException as e:
+            # 后台线程的异常不会传到主线程，保存下来由 wait() 抛出
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise RuntimeError('writing the checkpoint failed') from error